@@ -1,11 +1,20 @@
 # -*- coding: utf-8 -*-
 
-import inspect
+from importlib import import_module
 
 from django.db import models
 
 from .kentta import EI_ASETETTU, Lumekentta
-from . import puukko
+
+
+# Muut julkiset nimet ladataan vasta käytettäessä (ks. `__getattr__`).
+_MODUULIT = {
+  'alume': 'asynkroninen',
+  'riippuvuudet': 'riippuvuus',
+  'riippuvuusgraafi': 'riippuvuus',
+  'kantakysely': 'seuranta',
+  'seuraa': 'seuranta',
+}
 
 
 # Nimetään eri kenttäluokat tässä, jotta koodintarkistusalgoritmit eivät
@@ -48,10 +57,31 @@ ForeignKey: type
 OneToOneField: type
 
 
-# Periytä lumeversio kustakin Djangon kenttätyypistä.
-for nimi, luokka in inspect.getmembers(
-  models, lambda x: inspect.isclass(x) and issubclass(x, models.Field)
-):
-  globals()[nimi] = type(nimi, (Lumekentta, luokka), {})
-del inspect
-del models
+def __getattr__(nimi):
+  '''
+  Muodosta lumeversio pyydetystä Djangon kenttätyypistä (esim.
+  `lume.DecimalField`) ensimmäisellä käyttökerralla ja tallenna se
+  moduulin nimiavaruuteen; lataa muut julkiset nimet alimoduuleistaan.
+  '''
+  if nimi in _MODUULIT:
+    arvo = getattr(import_module(f'.{_MODUULIT[nimi]}', __name__), nimi)
+    return globals().setdefault(nimi, arvo)
+  luokka = getattr(models, nimi, None)
+  if not isinstance(luokka, type) \
+  or not issubclass(luokka, models.Field) \
+  or issubclass(luokka, Lumekentta):
+    raise AttributeError(f'module {__name__!r} has no attribute {nimi!r}')
+  return globals().setdefault(nimi, type(nimi, (Lumekentta, luokka), {}))
+  # def __getattr__
+
+
+def __dir__():
+  return sorted({
+    *globals(),
+    *_MODUULIT,
+    *(
+      nimi for nimi, luokka in vars(models).items()
+      if isinstance(luokka, type) and issubclass(luokka, models.Field)
+    ),
+  })
+  # def __dir__
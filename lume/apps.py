@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+
+from django.apps import AppConfig
+
+
+class LumeConfig(AppConfig):
+  name = 'lume'
+
+  def ready(self):
+    # pylint: disable=import-outside-toplevel
+    from . import arvovalimuisti, puukko, tallennettu
+    puukko.asenna()
+    tallennettu.kytke()
+    arvovalimuisti.kytke()
+    # def ready
+
+  # class LumeConfig
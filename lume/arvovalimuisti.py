@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+'''
+Lumekenttien arvojen pyyntöjen välinen välimuisti.
+
+Kentälle, jolle on annettu parametri `valimuisti=<sekuntia>`, lasketut
+arvot tallennetaan Djangon välimuistiin (`LUME_VALIMUISTI`, oletuksena
+`'default'`) avaimella (malli, pk, kenttä). Välimuistin koko rajataan
+taustan omilla asetuksilla (esim. `OPTIONS['MAX_ENTRIES']`).
+
+Kullakin kentällä on välimuistissa versionumero, joka sisältyy kaikkiin
+kentän avaimiin. Kun jonkin kentän riippuvuuksiin (ks. `riippuvuus.py`)
+kuuluvan mallin rivi tallennetaan tai poistetaan tai M2M-suhde muuttuu,
+versionumeroa kasvatetaan: kaikki kentän aiemmat arvot vanhenevat.
+Versionumero luetaan ennen arvon laskentaa, joten samanaikaisen muutoksen
+aikana laskettu arvo tallentuu vanhentuneelle avaimelle.
+
+Samaa puuttuvaa arvoa laskee kerrallaan vain yksi prosessi (lukko
+`cache.add`-kutsulla); muut odottavat hetken sen valmistumista.
+'''
+
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import models
+
+from .kentta import Lumekentta
+
+
+LUKON_KESTO = 10
+ODOTUS = 0.05
+ODOTUKSIA = 20
+
+
+class Tilasto:
+  ''' Kenttäkohtaiset osuma- ja ohituslaskurit. '''
+
+  def __init__(self):
+    self._lukko = threading.Lock()
+    self._laskurit = {}
+    # def __init__
+
+  def kirjaa(self, kentta, osumat=0, ohitukset=0):
+    with self._lukko:
+      laskurit = self._laskurit.setdefault(kentta, [0, 0])
+      laskurit[0] += osumat
+      laskurit[1] += ohitukset
+    # def kirjaa
+
+  def __call__(self, kentta=None):
+    '''
+    Palauta kentän (tai kaikkien kenttien yhteenlasketut) laskurit
+    sanakirjana `{'osumat': ..., 'ohitukset': ...}`.
+    '''
+    with self._lukko:
+      laskurit = [
+        arvot for avain, arvot in self._laskurit.items()
+        if kentta is None or avain is kentta
+      ]
+    return {
+      'osumat': sum(osumat for osumat, _ in laskurit),
+      'ohitukset': sum(ohitukset for _, ohitukset in laskurit),
+    }
+    # def __call__
+
+  def tyhjenna(self):
+    with self._lukko:
+      self._laskurit.clear()
+    # def tyhjenna
+
+  # class Tilasto
+
+
+tilasto = Tilasto()
+
+
+def kaytossa(kentta):
+  ''' Onko kentälle määritetty välimuisti? '''
+  return isinstance(kentta, Lumekentta) \
+    and kentta.valimuisti is not None \
+    and not kentta.tallennettu
+  # def kaytossa
+
+
+def _tausta():
+  return caches[getattr(settings, 'LUME_VALIMUISTI', 'default')]
+  # def _tausta
+
+
+def _nimi(kentta):
+  return f'lume:{kentta.model._meta.label_lower}.{kentta.name}'
+  # def _nimi
+
+
+def versio(kentta):
+  ''' Kentän välimuistiavainten nykyinen versionumero. '''
+  riippuvat_kentat(kentta.model)
+  tausta = _tausta()
+  avain = f'{_nimi(kentta)}:versio'
+  if (arvo := tausta.get(avain)) is None:
+    tausta.add(avain, 1, timeout=None)
+    arvo = tausta.get(avain, 1)
+  return arvo
+  # def versio
+
+
+def _avain(kentta, versio_, pk):
+  return f'{_nimi(kentta)}:{versio_}:{pk}'
+  # def _avain
+
+
+def hae(kentta, versio_, pks):
+  ''' Hae välimuistista; palauttaa sanakirjan `pk -> arvo`. '''
+  avaimet = {_avain(kentta, versio_, pk): pk for pk in pks}
+  tulos = {
+    avaimet[avain]: arvo
+    for avain, (arvo, ) in _tausta().get_many(avaimet).items()
+  }
+  tilasto.kirjaa(
+    kentta, osumat=len(tulos), ohitukset=len(avaimet) - len(tulos)
+  )
+  return tulos
+  # def hae
+
+
+def tallenna(kentta, versio_, arvot):
+  ''' Tallenna sanakirjan `pk -> arvo` mukaiset arvot välimuistiin. '''
+  if arvot:
+    _tausta().set_many({
+      _avain(kentta, versio_, pk): (arvo, )
+      for pk, arvo in arvot.items()
+    }, timeout=kentta.valimuisti)
+  # def tallenna
+
+
+def laske(kentta, rivi, laskenta):
+  '''
+  Palauta rivin kentän arvo välimuistista tai laske se funktiolla
+  `laskenta()` ja tallenna tulos.
+  '''
+  versio_ = versio(kentta)
+  if (arvo := hae(kentta, versio_, [rivi.pk])):
+    return arvo[rivi.pk]
+  tausta = _tausta()
+  lukko = f'{_avain(kentta, versio_, rivi.pk)}:lukko'
+  if not tausta.add(lukko, True, timeout=LUKON_KESTO):
+    # Toinen prosessi laskee saman arvon: odotetaan hetki.
+    for _ in range(ODOTUKSIA):
+      time.sleep(ODOTUS)
+      if (arvo := tausta.get(_avain(kentta, versio_, rivi.pk))) is not None:
+        tilasto.kirjaa(kentta, osumat=1)
+        return arvo[0]
+    lukko = None
+  try:
+    arvo = laskenta()
+    tallenna(kentta, versio_, {rivi.pk: arvo})
+  finally:
+    if lukko is not None:
+      tausta.delete(lukko)
+  return arvo
+  # def laske
+
+
+def mitatoi(kentta):
+  ''' Vanhenna kaikki kentän välimuistiin tallennetut arvot. '''
+  tausta = _tausta()
+  avain = f'{_nimi(kentta)}:versio'
+  try:
+    tausta.incr(avain)
+  except ValueError:
+    tausta.set(avain, 2, timeout=None)
+  # def mitatoi
+
+
+def valimuistikentat():
+  ''' Kaikkien asennettujen mallien välimuistia käyttävät lumekentät. '''
+  # pylint: disable=import-outside-toplevel
+  from django.apps import apps
+  return [
+    kentta
+    for malli in apps.get_models()
+    for kentta in malli._meta.concrete_fields
+    if kaytossa(kentta)
+  ]
+  # def valimuistikentat
+
+
+_riippuvat_kentat = {}
+_kytketty = False
+
+
+def riippuvat_kentat(malli):
+  '''
+  Ne välimuistia käyttävät kentät, jotka riippuvat annetusta mallista.
+
+  Mitätöinti kytketään tarvittaessa ensin (ks. `kytke`), jotta
+  välimuistia ei käytetä ilman sitä; ennen mallien latautumista tämä
+  nostaa poikkeuksen `AppRegistryNotReady`.
+  '''
+  if not _kytketty:
+    # pylint: disable=import-outside-toplevel
+    from django.apps import apps
+    apps.check_models_ready()
+    kytke()
+  return _riippuvat_kentat.get(malli, ())
+  # def riippuvat_kentat
+
+
+def mitatoi_malli(malli):
+  ''' Vanhenna niiden kenttien arvot, jotka riippuvat annetusta mallista. '''
+  for kentta in riippuvat_kentat(malli):
+    mitatoi(kentta)
+  # def mitatoi_malli
+
+
+def _muutos(sender, **kwargs):
+  # pylint: disable=unused-argument
+  mitatoi_malli(sender)
+  # def _muutos
+
+
+def kytke():
+  '''
+  Kytke mitätöinti riippuvien mallien signaaleihin.
+  Kutsutaan `LumeConfig.ready`-metodista tai välimuistin ensimmäisen
+  käytön yhteydessä (ks. `riippuvat_kentat`).
+  '''
+  # pylint: disable=import-outside-toplevel, global-statement
+  from .riippuvuus import riippuvat_mallit
+  global _kytketty
+  _kytketty = True
+  _riippuvat_kentat.clear()
+  for kentta in valimuistikentat():
+    for malli in riippuvat_mallit(kentta):
+      _riippuvat_kentat.setdefault(malli, []).append(kentta)
+  for malli in _riippuvat_kentat:
+    for signaali in (
+      models.signals.post_save,
+      models.signals.post_delete,
+      models.signals.m2m_changed,
+    ):
+      signaali.connect(
+        _muutos, sender=malli, dispatch_uid='lume.arvovalimuisti',
+      )
+  # def kytke
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+'''
+Lumekenttien asynkroninen laskenta.
+
+Asynkronisessa näkymässä kyselystä puuttuvan lumekentän lukeminen
+(`rivi.kentta`) suorittaisi synkronisen kyselyn. Sen sijaan puuttuvat
+arvot haetaan etukäteen:
+
+  async for rivi in Lasku.objects.aiterator():
+    await rivi.alume('rivien_summa', 'arvo_yli_500')
+    ...
+
+Kutsu täyttää pyydetyt kentät annetuille riveille sekä niille
+samasta kyselystä ladatuille sisarusriveille (ks. `ModelIterable.__iter__`),
+joilta kentät puuttuvat, yhdellä asynkronisella kyselyllä mallia kohti.
+Kentälle määritettyä `alaske`-funktiota käytetään ensin; synkronista
+`laske`-funktiota ei kutsuta, sillä se voi suorittaa synkronisia kyselyjä.
+Yksinkertainen kysely tulkitaan paikallisesti (ks. `tulkki.py`).
+'''
+
+import time
+
+from django.db import connections, models
+
+from .kentta import EI_ASETETTU, Lumekentta
+from . import seuranta, tulkki
+
+
+def _lumekentat(malli, nimet):
+  ''' Pyydetyt (tai kaikki tallentamattomat) lumekentät. '''
+  if nimet:
+    return [malli._meta.get_field(nimi) for nimi in nimet]
+  return [
+    kentta for kentta in malli._meta.concrete_fields
+    if isinstance(kentta, Lumekentta) and not kentta.tallennettu
+  ]
+  # def _lumekentat
+
+
+async def _kysy_kannasta(malli, rivit, kentat):
+  '''
+  Kysy kenttien arvot annetuille riveille; palauttaa sanakirjan
+  `pk -> (arvo, ...)`. Vrt. `Lumekentta._kysy_kannasta`.
+  '''
+  qs = malli._base_manager.db_manager(None, hints={'instance': rivit[0]})
+  koko = max(connections[qs.db].ops.bulk_batch_size(
+    [malli._meta.pk], rivit
+  ), 1)
+  arvot = {}
+  for alku in range(0, len(rivit), koko):
+    async for pk, *_arvot in qs.filter(
+      pk__in=[rivi.pk for rivi in rivit[alku:alku + koko]]
+    ).values_list('pk', *(kentta.get_attname() for kentta in kentat)):
+      arvot[pk] = _arvot
+  return arvot
+  # def _kysy_kannasta
+
+
+async def alume(rivit, *kentat):
+  '''
+  Täytä rivin tai rivien (esim. luettelo) puuttuvat lumekentät
+  asynkronisesti. Mikäli kenttiä ei nimetä, täytetään kaikki
+  (tallentamattomat) lumekentät.
+
+  Palauttaa annetun rivin tai rivit.
+  '''
+  # pylint: disable=protected-access
+  annetut = [rivit] if isinstance(rivit, models.Model) else list(rivit)
+  mallit = {}
+  for rivi in annetut:
+    mallit.setdefault(type(rivi), []).append(rivi)
+
+  for malli, _rivit in mallit.items():
+    _kentat = _lumekentat(malli, kentat)
+
+    # Asynkroninen laskentafunktio annetuille riveille.
+    for kentta in _kentat:
+      if kentta._alaske is None:
+        continue
+      attname = kentta.get_attname()
+      for rivi in _rivit:
+        if attname not in rivi.__dict__ \
+        and (arvo := await kentta._alaske(rivi)) is not EI_ASETETTU:
+          rivi.__dict__[attname] = getattr(arvo, 'pk', arvo)
+          seuranta.kirjaa(kentta, 'laske')
+
+    # Yksinkertaisen kyselyn tulkinta luettujen sarakkeiden perusteella.
+    for kentta in _kentat:
+      attname = kentta.get_attname()
+      for rivi in _rivit:
+        if attname not in rivi.__dict__ \
+        and (arvo := tulkki.laske(kentta, rivi)) is not EI_ASETETTU:
+          rivi.__dict__[attname] = arvo
+          seuranta.kirjaa(kentta, 'tulkki')
+
+    # Uusille riville ei tehdä kyselyä.
+    for rivi in _rivit:
+      if rivi.pk is None:
+        for kentta in _kentat:
+          rivi.__dict__.setdefault(kentta.get_attname(), None)
+
+    # Muut puuttuvat arvot kannasta, myös sisarusriveille.
+    haettavat = {}
+    for rivi in _rivit:
+      if rivi.pk is None:
+        continue
+      for sisarus in (rivi, *(
+        viittaus() for viittaus in getattr(rivi._state, 'lume_sisarukset', ())
+      )):
+        if sisarus is not None and sisarus.pk is not None and any(
+          kentta.get_attname() not in sisarus.__dict__ for kentta in _kentat
+        ):
+          haettavat.setdefault(id(sisarus), sisarus)
+    if not haettavat:
+      continue
+    haettavat = list(haettavat.values())
+    puuttuvat = [
+      kentta for kentta in _kentat
+      if any(kentta.get_attname() not in rivi.__dict__ for rivi in haettavat)
+    ]
+    alku = time.perf_counter()
+    arvot = await _kysy_kannasta(malli, haettavat, puuttuvat)
+    kesto = time.perf_counter() - alku
+    for kentta in puuttuvat:
+      seuranta.kirjaa_kantakysely(kentta, kesto, len(haettavat))
+    for rivi in haettavat:
+      if rivi.pk not in arvot:
+        continue
+      for kentta, arvo in zip(puuttuvat, arvot[rivi.pk]):
+        rivi.__dict__.setdefault(kentta.get_attname(), arvo)
+  return rivit
+  # def alume
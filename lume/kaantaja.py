@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+
+from django.conf import settings
+from django.db import models
+from django.db.models.query import MAX_GET_RESULTS
+from django.db.models.sql.datastructures import Join
+from django.db.models.sql.query import Query
+from django.db.models.sql.where import WhereNode
+
+from .sarake import Lumesarake
+
+
+# Tietokantakohtainen "optimointiaita", joka estää sisemmän kyselyn
+# yhdistämisen (flattening) ulompaan. Parametrinä kerrotaan, onko
+# sisemmällä kyselyllä jo LIMIT-ehto.
+AITA = {
+  'sqlite': lambda limit: ' OFFSET 0' if limit else ' LIMIT -1 OFFSET 0',
+  'postgresql': lambda limit: ' OFFSET 0',
+}
+
+ALIAS = '__lume'
+
+
+def _lauseet(lauseke):
+  ''' Käy läpi lausekepuun kaikki solmut. '''
+  yield lauseke
+  for lapsi in lauseke.get_source_expressions():
+    if lapsi is not None and hasattr(lapsi, 'get_source_expressions'):
+      yield from _lauseet(lapsi)
+  # def _lauseet
+
+
+def paikallinen_lauseke(kentta):
+  '''
+  Ratkaise lumekentän kysely mallin omaa taulua vasten.
+
+  Palauttaa parin (lauseke, sarakkeet), mikäli lauseke viittaa pelkästään
+  saman taulun (todellisiin tai lume-) sarakkeisiin ilman liitoksia tai
+  alikyselyjä ja vähintään yksi näistä on lumesarake; muuten `None`.
+
+  Tulos tallennetaan kentälle kyselyversion mukaan.
+  '''
+  tallennettu = kentta.__dict__.get('_paikallinen_lauseke')
+  if tallennettu is not None and tallennettu[0] == kentta.kyselyversio:
+    return tallennettu[1]
+  tulos = None
+  query = Query(kentta.model)
+  try:
+    lauseke = kentta.kysely.resolve_expression(query)
+  except Exception: # pylint: disable=broad-except
+    lauseke = None
+  # Huom. karsitut liitokset jäävät `alias_map`-sanakirjaan;
+  # varsinaiset viittaukset tarkistetaan sarakkeiden aliaksista.
+  if lauseke is not None and hasattr(lauseke, 'get_source_expressions'):
+    sarakkeet = []
+    for solmu in _lauseet(lauseke):
+      if hasattr(solmu, 'query') or isinstance(solmu, (
+        models.expressions.RawSQL,
+        models.expressions.ResolvedOuterRef,
+      )):
+        break
+      if isinstance(solmu, models.expressions.Col):
+        if solmu.alias != kentta.model._meta.db_table:
+          break
+        sarakkeet.append(solmu)
+    else:
+      if any(isinstance(sarake, Lumesarake) for sarake in sarakkeet):
+        tulos = (lauseke, sarakkeet)
+  kentta.__dict__['_paikallinen_lauseke'] = (kentta.kyselyversio, tulos)
+  return tulos
+  # def paikallinen_lauseke
+
+
+def yhteiset_alilausekkeet(compiler, with_limits=True):
+  '''
+  Muodosta SELECT-kysely, jossa useampaan kertaan tarvittavat lumekentät
+  lasketaan vain kerran.
+
+  Mikäli valittu lumekenttä riippuu ainoastaan saman taulun muista
+  lumekentistä (esim. `~Q(viimeisin_lasku=F('vanhin_lasku'))`) ja jokin
+  näistä tarvitaan myös muualla SELECT-lausekkeessa, kysely kääritään:
+  sisempi kysely laskee kunkin lumekentän kerran ja ulompi kysely johtaa
+  riippuvat kentät sen tuloksista.
+
+  Kirjoitusta ei tehdä `select_related`-kyselylle: viitattujen taulujen
+  liitokset muodostetaan SELECT-lausekkeen yhteydessä, eikä sisempi
+  kysely (valmiine SELECT-lausekkeineen) sisältäisi niitä.
+
+  Edellyttää, että `compiler.as_sql()` on jo suoritettu (`compiler.select`).
+  Palauttaa (sql, params) tai `None`, mikäli kirjoitusta ei tehdä.
+  '''
+  # pylint: disable=too-many-locals, too-many-branches
+  query = compiler.query
+  aita = AITA.get(compiler.connection.vendor)
+  if aita is None \
+  or not getattr(settings, 'LUME_YHTEISET_ALILAUSEKKEET', True) \
+  or query.subquery \
+  or query.combinator \
+  or query.distinct \
+  or query.select_for_update \
+  or query.select_related \
+  or query.group_by is not None \
+  or query.extra_select \
+  or compiler.qualify is not None:
+    return None
+
+  alias = query.base_table
+  db_table = query.model._meta.db_table
+
+  def avain(sarake):
+    return (sarake.alias, sarake.target)
+
+  # Poimi valitut lumesarakkeet, joiden lauseke voidaan johtaa
+  # muista saman taulun sarakkeista.
+  riippuvat = {}
+  for indeksi, (lauseke, _, _) in enumerate(compiler.select):
+    if isinstance(lauseke, Lumesarake) and lauseke.alias == alias:
+      if (tulos := paikallinen_lauseke(lauseke.target)) is not None:
+        riippuvat[indeksi] = tulos
+  if not riippuvat:
+    return None
+
+  # Lasketaan kunkin lumesarakkeen käyttökerrat.
+  kaytot = {}
+  for indeksi, (lauseke, _, _) in enumerate(compiler.select):
+    if indeksi not in riippuvat and isinstance(lauseke, Lumesarake):
+      kaytot[avain(lauseke)] = kaytot.get(avain(lauseke), 0) + 1
+  for _, sarakkeet in riippuvat.values():
+    for sarake in sarakkeet:
+      if isinstance(sarake, Lumesarake):
+        sarake = sarake.relabeled_clone({db_table: alias})
+        kaytot[avain(sarake)] = kaytot.get(avain(sarake), 0) + 1
+  if all(lkm < 2 for lkm in kaytot.values()):
+    return None
+
+  # Muodosta sisemmän kyselyn SELECT-lausekkeet.
+  sisemmat = []
+  sijainnit = {}
+  for indeksi, (lauseke, _, _) in enumerate(compiler.select):
+    if indeksi in riippuvat:
+      continue
+    if isinstance(lauseke, models.expressions.Col):
+      sijainnit.setdefault(avain(lauseke), len(sisemmat))
+    sisemmat.append(lauseke)
+  korvaukset = {}
+  for indeksi, (_, sarakkeet) in riippuvat.items():
+    for sarake in sarakkeet:
+      sisainen = sarake.relabeled_clone({db_table: alias})
+      if avain(sisainen) not in sijainnit:
+        sijainnit[avain(sisainen)] = len(sisemmat)
+        sisemmat.append(sisainen)
+      korvaukset[sarake] = sijainnit[avain(sisainen)]
+
+  # Järjestys toistetaan ulommassa kyselyssä (vrt. Djangon
+  # `get_qualify_sql`): alikyselyn (derived table) rivijärjestys ei
+  # välity ulompaan kyselyyn. Järjestyksen lausekkeet poimitaan
+  # tarvittaessa sisemmän kyselyn sarakkeiksi.
+  jarjestys = []
+  for order_by, _ in compiler.get_order_by():
+    viittaukset = {}
+    for lauseke in order_by.get_source_expressions():
+      lahde = lauseke.source \
+        if isinstance(lauseke, models.expressions.Ref) else lauseke
+      try:
+        viittaukset[lauseke] = sisemmat.index(lahde)
+      except ValueError:
+        viittaukset[lauseke] = len(sisemmat)
+        sisemmat.append(lahde)
+    jarjestys.append((order_by, viittaukset))
+
+  sisempi_query = query.clone()
+  sisempi_query.clear_select_clause()
+  sisempi_query.select = tuple(sisemmat)
+  sisempi_query.explain_info = None
+  sisempi = sisempi_query.get_compiler(
+    compiler.using,
+    connection=compiler.connection,
+    elide_empty=compiler.elide_empty,
+  )
+  sisempi_sql, sisemmat_params = sisempi.as_sql(
+    with_limits=with_limits, with_col_aliases=True,
+  )
+  if not (with_limits and query.low_mark):
+    sisempi_sql += aita(with_limits and query.high_mark is not None)
+
+  # Muodosta ulompi kysely.
+  sarakkeet, params = [], []
+  lapimenevat = iter(sisempi.select)
+  for indeksi, (lauseke, _, _) in enumerate(compiler.select):
+    if indeksi in riippuvat:
+      riippuva, _sarakkeet = riippuvat[indeksi]
+      sql, _params = compiler.compile(riippuva.replace_expressions({
+        sarake: models.expressions.Ref(
+          sisempi.select[korvaukset[sarake]][2], sarake
+        )
+        for sarake in _sarakkeet
+      }))
+      sql, _params = lauseke.select_format(compiler, sql, _params)
+      sarakkeet.append(sql)
+      params.extend(_params)
+    else:
+      sarakkeet.append(
+        compiler.connection.ops.quote_name(next(lapimenevat)[2])
+      )
+  sql = 'SELECT %s FROM (%s) %s' % (
+    ', '.join(sarakkeet),
+    sisempi_sql,
+    compiler.connection.ops.quote_name(ALIAS),
+  )
+  jarjestys_sql, jarjestys_params = [], []
+  for order_by, viittaukset in jarjestys:
+    _sql, _params = compiler.compile(order_by.replace_expressions({
+      lauseke: models.expressions.Ref(sisempi.select[indeksi][2], lauseke)
+      for lauseke, indeksi in viittaukset.items()
+    }))
+    jarjestys_sql.append(_sql)
+    jarjestys_params.extend(_params)
+  if jarjestys_sql:
+    sql += ' ORDER BY %s' % ', '.join(jarjestys_sql)
+  if query.explain_info:
+    sql = ' '.join((
+      compiler.connection.ops.explain_query_prefix(
+        query.explain_info.format,
+        **query.explain_info.options,
+      ),
+      sql,
+    ))
+  return sql, (*params, *sisemmat_params, *jarjestys_params)
+  # def yhteiset_alilausekkeet
+
+
+def _sisaltaa_lumesarakkeen(lauseke):
+  ''' Viittaako lauseke (myös alikyselyineen) johonkin lumesarakkeeseen? '''
+  return any(
+    isinstance(solmu, Lumesarake)
+    for solmu in _lauseet(lauseke)
+  )
+  # def _sisaltaa_lumesarakkeen
+
+
+def sivutus(compiler, with_col_aliases=False):
+  '''
+  Muodosta rajatulle (`qs[100:125]`) kyselylle SELECT-kysely, jossa
+  lumekentät lasketaan vain sivun riveille.
+
+  Sisempi kysely poimii sivun rivien avaimet pelkkien todellisten
+  sarakkeiden mukaan (WHERE, ORDER BY, LIMIT/OFFSET); ulompi kysely
+  laskee valitut lumekentät näille riveille samassa järjestyksessä:
+
+    SELECT ..., (lumekysely) FROM taulu
+    WHERE taulu.id IN (SELECT id FROM taulu WHERE ... ORDER BY ... LIMIT ...)
+    ORDER BY ...
+
+  Kirjoitus tehdään vain, kun kysely ohittaa rivejä tai on rajattu
+  useampaan kuin `LUME_SIVUTUS_RAJA` riviin, valittujen sarakkeiden
+  joukossa on rivikohtaisesti laskettava lumesarake eikä hakuehto tai
+  järjestys viittaa lumekenttiin, kysely ei sisällä ikkunafunktioita ja
+  kyselyn liitokset ovat yksikäsitteisiä (viittaus- tai 1:1-liitoksia).
+
+  Edellyttää, että `compiler.as_sql()` on jo suoritettu (`compiler.select`).
+  Palauttaa (sql, params) tai `None`, mikäli kirjoitusta ei tehdä.
+  '''
+  query = compiler.query
+  if with_col_aliases \
+  or not getattr(settings, 'LUME_SIVUTUS', True) \
+  or not query.is_sliced \
+  or query.subquery \
+  or query.combinator \
+  or query.distinct \
+  or query.select_for_update \
+  or query.group_by is not None \
+  or query.extra \
+  or query.extra_order_by \
+  or compiler.qualify is not None \
+  or not compiler.connection.features.allow_sliced_subqueries_with_in:
+    return None
+  # Ensimmäinen, enintään `LUME_SIVUTUS_RAJA` rivin sivu (esim. `.get()`,
+  # `.first()`) poimitaan sellaisenaan.
+  if not query.low_mark \
+  and query.high_mark <= getattr(
+    settings, 'LUME_SIVUTUS_RAJA', MAX_GET_RESULTS
+  ):
+    return None
+  # Ryhmitellyn liitoksen avulla laskettu kenttä (ks. `liitos.py`) ei
+  # hyödy sivutuksesta.
+  liitokset = getattr(compiler, 'lume_liitokset', {})
+  if not any(
+    isinstance(solmu, Lumesarake)
+    and (solmu.target, solmu.alias) not in liitokset
+    for lauseke, _, _ in compiler.select
+    for solmu in _lauseet(lauseke)
+  ):
+    return None
+  if _sisaltaa_lumesarakkeen(query.where) or any(
+    _sisaltaa_lumesarakkeen(lauseke)
+    for lauseke, _ in compiler.get_order_by()
+  ):
+    return None
+  # Ikkunafunktio lasketaan koko rivijoukon yli, ei vain sivun riveille.
+  if any(
+    getattr(lauseke, 'contains_over_clause', False)
+    for lauseke in (
+      *(lauseke for lauseke, _, _ in compiler.select),
+      *query.annotations.values(),
+      *(lauseke for lauseke, _ in compiler.get_order_by()),
+    )
+  ):
+    return None
+  if any(
+    isinstance(liitos, Join) and not (
+      liitos.join_field.many_to_one or liitos.join_field.one_to_one
+    )
+    for liitos in query.alias_map.values()
+  ):
+    return None
+
+  # Sivun rivien avaimet.
+  sisempi = query.clone()
+  sisempi.clear_select_clause()
+  sisempi.select_related = False
+  sisempi.add_fields(['pk'])
+
+  # Lumekentät lasketaan ulommassa kyselyssä vain näille riveille.
+  # Hakuehtojen liitokset jäävät ulompaan kyselyyn; ne ovat
+  # yksikäsitteisiä eivätkä rajaa sisemmän kyselyn poimimia rivejä.
+  ulompi = query.clone()
+  ulompi.clear_limits()
+  ulompi.where = WhereNode()
+  ulompi.add_q(models.Q(pk__in=sisempi))
+  ulompi.lume_rivimaara = query.high_mark - query.low_mark \
+    if query.high_mark is not None else None
+  return ulompi.get_compiler(
+    compiler.using,
+    connection=compiler.connection,
+    elide_empty=compiler.elide_empty,
+  ).as_sql()
+  # def sivutus
@@ -2,9 +2,10 @@
 
 import functools
 from inspect import signature
+import time
 
 from django.conf import settings
-from django.db import models
+from django.db import connections, models
 from django.utils.functional import cached_property, classproperty
 
 from .maare import Lumemaare, LumeFM2OMaare
@@ -13,13 +14,66 @@ from .sarake import Lumesarake
 
 EI_ASETETTU = object()
 
+# Aliasmuunnos, joka ei muuta mitään aliasta (ks. `_eristetty`).
+_ERISTYS = {'lume:eristys': 'lume:eristetty'}
+
+
+def _eristetty(lauseke):
+  '''
+  Kopio lausekkeesta niin, että myös sen (alikyselyjen) hakuehdot
+  kopioidaan.
+
+  Django korvaa hakuehtojen `OuterRef`-viittaukset paikallaan
+  (`WhereNode.resolve_expression`) silloin, kun alikyselyn aliaksia ei
+  tarvitse muuttaa; tällöin yhteinen pohjalauseke muuttuisi ensimmäisen
+  käyttökerran mukaiseksi. Alikyselyt kopioidaan `relabeled_clone`-
+  kutsulla, joka kopioi myös niiden ehdot rekursiivisesti.
+  '''
+  if isinstance(lauseke, models.Q):
+    kopio = lauseke.copy()
+    kopio.children = [
+      (lapsi[0], _eristetty(lapsi[1])) if isinstance(lapsi, tuple)
+      else _eristetty(lapsi)
+      for lapsi in lauseke.children
+    ]
+    return kopio
+  if isinstance(lauseke, models.sql.Query):
+    return lauseke.relabeled_clone(_ERISTYS)
+  if hasattr(lauseke, 'get_source_expressions'):
+    kopio = lauseke.copy()
+    kopio.set_source_expressions([
+      _eristetty(lahde) for lahde in lauseke.get_source_expressions()
+    ])
+    return kopio
+  return lauseke
+  # def _eristetty
+
+
+def luokkakohtainen(funktio):
+  '''
+  Luokkaominaisuus, jonka arvo muodostetaan kerran kullekin luokalle
+  ja tallennetaan sen omaan sanakirjaan (ei periytyviin luokkiin).
+  '''
+  avain = f'_{funktio.__name__}_valimuisti'
+  @functools.wraps(funktio)
+  def _funktio(cls):
+    try:
+      return cls.__dict__[avain]
+    except KeyError:
+      pass
+    arvo = funktio(cls)
+    setattr(cls, avain, arvo)
+    return arvo
+  return classproperty(_funktio)
+  # def luokkakohtainen
+
 
 class Lumekentta(models.fields.Field):
 
   # Django 5+: generoitu kenttä, joka ohitetaan tallennettaessa.
   generated = True
 
-  @classproperty
+  @luokkakohtainen
   def forward_related_accessor_class(cls):
     # pylint: disable=no-self-argument, invalid-name, no-member
     # Huomaa, että super-toteutusta ei ole määritelty kaikille kenttätyypeille.
@@ -32,7 +86,7 @@ class Lumekentta(models.fields.Field):
     return forward_related_accessor_class
     # def forward_related_accessor_class
 
-  @classproperty
+  @luokkakohtainen
   def descriptor_class(cls):
     # pylint: disable=no-self-argument, invalid-name
     @functools.wraps(super().descriptor_class, updated=())
@@ -42,7 +96,8 @@ class Lumekentta(models.fields.Field):
 
   def __init__(
     self, *args,
-    kysely, laske=None, aseta=None, automaattinen=False,
+    kysely, laske=None, aseta=None, automaattinen=False, alaske=None,
+    laske_joukko=None, strategia='alikysely', tallennettu=False, valimuisti=None,
     **kwargs
   ):
     '''
@@ -52,6 +107,17 @@ class Lumekentta(models.fields.Field):
       laske (`lambda self`): paikallinen laskentafunktio
       aseta (`lambda *args`): paikallinen arvon asetusfunktio
       automaattinen (`bool`): lisätäänkö kenttä automaattisesti kyselyyn?
+      alaske (`async lambda self`): paikallinen laskentafunktio
+        asynkronista käyttöä varten (ks. `asynkroninen.py`)
+      laske_joukko (`lambda rivit`): paikallinen laskentafunktio usealle
+        riville kerralla; palauttaa sanakirjan `pk -> arvo`
+      strategia (`str`): 'alikysely' (oletus) tai 'liitos': lasketaanko
+        koostefunktio ryhmitellyn liitoksen avulla, kun mahdollista?
+      tallennettu (`bool`): tallennetaanko arvo kantaan omaan sarakkeeseensa
+        ja päivitetäänkö se riippuvien mallien muuttuessa (ks. `tallennettu.py`)?
+        Raakaa SQL:ää tai signaaleja ohittavia muutoksia ei seurata.
+      valimuisti (`int`): säilytetäänkö lasketut arvot Djangon välimuistissa
+        annetun ajan sekunteina (ks. `arvovalimuisti.py`)?
     '''
     # Lisää super-kutsuun parametri `editable=False`,
     # jos `aseta`-funktiota ei ole määritetty.
@@ -63,78 +129,205 @@ class Lumekentta(models.fields.Field):
     self.default = EI_ASETETTU
 
     self._kysely = kysely
+    self.kyselyversio = 0
     self._laske = laske
+    self._alaske = alaske
+    self._laske_joukko = laske_joukko
     self._aseta = aseta
     self.automaattinen = automaattinen
+    if strategia not in ('alikysely', 'liitos'):
+      raise ValueError(f'Tuntematon strategia: {strategia!r}')
+    self.strategia = strategia
+    self.tallennettu = tallennettu
+    self.valimuisti = valimuisti
 
     self.serialize = False
     # def __init__
 
+  def contribute_to_class(self, cls, name, *args, **kwargs):
+    '''
+    Asenna lumen Django-korvaukset ennen ensimmäisen mallin luontia;
+    kytke tallennetun kentän ylläpito (ks. `tallennettu.kytke`).
+    '''
+    # pylint: disable=import-outside-toplevel
+    from .puukko import asenna
+    asenna()
+    super().contribute_to_class(cls, name, *args, **kwargs)
+    if self.tallennettu:
+      from . import tallennettu
+      tallennettu.kytke()
+    # def contribute_to_class
+
+  @classmethod
+  def perusluokka(cls):
+    ''' Djangon kenttäluokka, josta tämä lumekenttäluokka on periytetty. '''
+    return next(
+      luokka for luokka in cls.__mro__
+      if not issubclass(luokka, Lumekentta)
+    )
+    # def perusluokka
+
   def deconstruct(self):
     name, path, args, kwargs = super().deconstruct()
+    if self.tallennettu:
+      # Tallennettu kenttä näkyy migraatioille tavallisena sarakkeena.
+      perusluokka = self.perusluokka()
+      if getattr(models, perusluokka.__name__, None) is perusluokka:
+        path = f'django.db.models.{perusluokka.__name__}'
+      else:
+        path = f'{perusluokka.__module__}.{perusluokka.__qualname__}'
+      for avain in ('default', 'editable', 'serialize'):
+        kwargs.pop(avain, None)
+      return name, path, args, kwargs
     return name, path, args, dict(
       kysely=self.kysely,
       **kwargs
     )
     # def deconstruct
 
+  def clone(self):
+    ''' Tallennettu kenttä kloonataan tavallisena kenttänä (migraatiot). '''
+    if self.tallennettu:
+      _, _, args, kwargs = self.deconstruct()
+      return self.perusluokka()(*args, **kwargs)
+    return super().clone()
+    # def clone
+
   def formfield(self, **kwargs):
     ''' Nollataan lomakkeelle annettu `initial`-arvo (EI_ASETETTU). '''
     return super().formfield(**{**kwargs, 'initial': None})
 
   @property
   def kysely(self):
-    ''' Hae kyselylauseke (joko lambda tai suora arvo) '''
+    '''
+    Hae kyselylauseke (joko lambda tai suora arvo).
+
+    Lambdan palauttama lauseke muodostetaan kerran ja tallennetaan
+    välimuistiin. Kutsujalle palautetaan siitä erillinen kopio
+    (ks. `_eristetty`), sillä Django voi muuttaa lauseketta kyselyyn
+    liitettäessä (`resolve_expression`).
+    '''
+    try:
+      return _eristetty(self.__dict__['_kysely_valimuisti'])
+    except KeyError:
+      pass
     if not callable(self._kysely):
-      return self._kysely
+      kysely = self._kysely
     elif signature(self._kysely).parameters:
-      return self._kysely(kentta=self)
-    return self._kysely()
+      kysely = self._kysely(kentta=self)
+    else:
+      kysely = self._kysely()
+    self.__dict__['_kysely_valimuisti'] = kysely
+    return _eristetty(kysely)
     # def kysely
   @kysely.setter
   def kysely(self, kysely):
     self._kysely = kysely
+    self.tyhjenna_kysely()
     # def kysely
 
+  def tyhjenna_kysely(self):
+    '''
+    Tyhjennä välimuistiin tallennettu kyselylauseke ja kasvata
+    kentän kyselyversiota, jotta lausekkeesta johdetut välimuistit
+    vanhenevat.
+    '''
+    self.__dict__.pop('_kysely_valimuisti', None)
+    self.kyselyversio += 1
+    # Sisäkkäiset lumekentät sisältyvät muiden kenttien käännöksiin.
+    Lumesarake.valimuisti.tyhjenna()
+    # def tyhjenna_kysely
+
   def laske_paikallisesti(self, rivi, select_related=False):
+    '''
+    Palautetaan kentän arvo välimuistista, mikäli kentälle on määritetty
+    `valimuisti`; muuten (tai välimuistin puuttuessa) lasketaan arvo.
+
+    Välimuistia käytettäessä (`select_related=True`) palautetaan
+    viitatun rivin avain, jonka mukaan kutsuva kuvaaja hakee rivin.
+    '''
+    # pylint: disable=import-outside-toplevel
+    from . import arvovalimuisti
+    if rivi.pk is None or not arvovalimuisti.kaytossa(self):
+      return self._laske_paikallisesti(rivi, select_related=select_related)
+    return arvovalimuisti.laske(
+      self, rivi, lambda: self._laske_paikallisesti(rivi)
+    )
+    # def laske_paikallisesti
+
+  def _laske_paikallisesti(self, rivi, select_related=False):
     '''
     Lasketaan kentän arvo paikallisesti, jos
     - laskentafunktio on määritelty; ja
     - laskentafunktio palauttaa muun arvon kuin EI_ASETETTU.
 
-    Muuten kysytään kenttää erikseen kannasta, mikäli rivi on olemassaoleva.
-    Tällöin sovelletaan `LUME_PAIKALLINEN_LASKENTA`-asetusparametriä:
+    Olemassaolevan rivin arvo lasketaan ensisijaisesti joukkofunktiolla
+    (`laske_joukko`) yhdessä niiden sisarusrivien kanssa, joilta kenttä
+    puuttuu (ks. alla). Funktion palauttamasta sanakirjasta puuttuvan
+    rivin arvo on `None`; arvo EI_ASETETTU ohittaa joukkolaskennan.
+
+    Muuten yksinkertainen kysely (`Q`, `F`, laskutoimitukset jne.)
+    tulkitaan paikallisesti rivin jo luettujen sarakkeiden perusteella,
+    mikäli kaikki tarvittavat sarakkeet ovat saatavilla (ks. `tulkki.py`).
+
+    Lopuksi kysytään kenttää erikseen kannasta, mikäli rivi on olemassaoleva.
+    Sama kysely täyttää kentän arvon myös kaikille samasta kyselystä
+    ladatuille sisarusriveille (ks. `ModelIterable.__iter__`).
+    Kysely kirjataan seurantaan (ks. `seuranta.py`). Lisäksi
+    sovelletaan `LUME_PAIKALLINEN_LASKENTA`-asetusparametriä:
     - "raise": nostetaan poikkeus
     - "print": tulostetaan tieto
     - "breakpoint": keskeytetään suoritus.
 
     Uudelle riville arvona palautuu `None` silloin, kun paikallista
-    laskentafunktiota ei ole määritelty.
+    laskentafunktiota ei ole määritelty eikä kyselyä voida tulkita.
 
     Parametrillä `select_related=True` palautetaan kokonainen, viitattu
-    (M2O tai O2O) rivi kannasta.
+    (M2O tai O2O) rivi kannasta; kantakyselyssä se haetaan samalla
+    kyselyllä avaimen kanssa. Viitatut rivit asetetaan samalla myös
+    sisarusrivien välimuistiin.
     '''
-    # pylint: disable=protected-access
+    # pylint: disable=protected-access, import-outside-toplevel
+    from . import seuranta, tulkki
+    if callable(self._laske_joukko) and rivi.pk is not None:
+      sisarukset = self._sisarukset(rivi)
+      arvot = self._laske_joukko([rivi, *sisarukset])
+      attname = self.get_attname()
+      for sisarus in sisarukset:
+        if (arvo := arvot.get(sisarus.pk)) is not EI_ASETETTU:
+          sisarus.__dict__[attname] = getattr(arvo, 'pk', arvo)
+      if (arvo := arvot.get(rivi.pk)) is not EI_ASETETTU:
+        seuranta.kirjaa(self, 'laske')
+        if select_related:
+          return arvo
+        return getattr(arvo, 'pk', arvo)
+      # if callable
+
     if callable(self._laske):
       arvo = self._laske(rivi)
       if arvo is not EI_ASETETTU:
+        seuranta.kirjaa(self, 'laske')
         if select_related:
           return arvo
         return getattr(arvo, 'pk', arvo)
       # if callable
 
+    # Tulkitaan kysely paikallisesti, mikäli kaikki sen viittaamat
+    # sarakkeet on jo luettu (ks. `tulkki.py`).
+    if (arvo := tulkki.laske(self, rivi)) is not EI_ASETETTU:
+      seuranta.kirjaa(self, 'tulkki')
+      return arvo
+
     # Ohitetaan tarpeeton kysely silloin, kun rivi on uusi.
     if rivi.pk is None:
       return None
 
-    # Kysytään erikseen kannasta.
+    # Kysytään erikseen kannasta; samalla kertaa myös niille saman
+    # kyselyn palauttamille riveille (sisaruksille), joilta kenttä puuttuu.
     # Vrt. `django.db.models.Model.refresh_from_db`.
     qs = rivi.__class__._base_manager.db_manager(
       None, hints={'instance': rivi}
-    ).filter(pk=rivi.pk).only(self.get_attname())
-    # Ei toimi toistaiseksi.
-    #if select_related:
-    #  qs = qs.select_related(self.name)
+    )
     if hasattr(settings, 'CONFIG'):
       if (paikallinen := settings.CONFIG(
         'LUME_PAIKALLINEN_LASKENTA',
@@ -151,12 +344,123 @@ class Lumekentta(models.fields.Field):
         )
       elif paikallinen == 'breakpoint':
         breakpoint()
-    try:
-      #return getattr(qs.get(), self.name if select_related else self.get_attname())
-      return getattr(qs.get(), self.get_attname())
-    except qs.model.DoesNotExist:
-      return None
-    # def laske_paikallisesti
+    sisarukset = self._sisarukset(rivi)
+    select_related = select_related and self.is_relation
+    alku = time.perf_counter()
+    arvot = self._kysy_kannasta(
+      qs, [rivi, *sisarukset], select_related=select_related,
+    )
+    seuranta.kirjaa_kantakysely(
+      self, time.perf_counter() - alku, 1 + len(sisarukset)
+    )
+    attname = self.get_attname()
+    for sisarus in sisarukset:
+      if sisarus.pk in arvot:
+        arvo = arvot[sisarus.pk]
+        if select_related:
+          self.set_cached_value(sisarus, arvo)
+          arvo = getattr(arvo, 'pk', None)
+        sisarus.__dict__[attname] = arvo
+    return arvot.get(rivi.pk)
+    # def _laske_paikallisesti
+
+  async def alaske_paikallisesti(self, rivi):
+    '''
+    Asynkroninen vastine `laske_paikallisesti`-metodille:
+    lasketaan arvo `alaske`-funktiolla tai kysytään kannasta
+    (yhdessä sisarusrivien kanssa). Ks. `asynkroninen.alume`.
+    '''
+    # pylint: disable=import-outside-toplevel
+    from .asynkroninen import alume
+    await alume(rivi, self.name)
+    return rivi.__dict__.get(self.get_attname())
+    # def alaske_paikallisesti
+
+  def _sisarukset(self, rivi):
+    '''
+    Poimi ne rivin kanssa samasta kyselystä ladatut, tallennetut rivit,
+    joille tämän kentän arvoa ei vielä ole laskettu.
+    '''
+    # pylint: disable=protected-access
+    attname = self.get_attname()
+    sisarukset = []
+    for viittaus in getattr(rivi._state, 'lume_sisarukset', ()):
+      sisarus = viittaus()
+      if sisarus is None \
+      or sisarus is rivi \
+      or sisarus.pk is None \
+      or attname in sisarus.__dict__:
+        continue
+      sisarukset.append(sisarus)
+    return sisarukset
+    # def _sisarukset
+
+  def laske_rivit(self, rivit):
+    '''
+    Laske kentän arvo kerralla kaikille niille annetuille, tallennetuille
+    riveille, joilta se puuttuu (ks. `LumeFM2OMaare.get_prefetch_querysets`):
+    ensisijaisesti joukkofunktiolla (`laske_joukko`), muuten yhdellä
+    kantakyselyllä. Rivikohtaista `laske`-funktiota ei käytetä.
+    '''
+    # pylint: disable=protected-access, import-outside-toplevel
+    from . import seuranta
+    if self.tallennettu:
+      return
+    attname = self.get_attname()
+    rivit = [
+      rivi for rivi in rivit
+      if rivi.pk is not None and attname not in rivi.__dict__
+    ]
+    if rivit and callable(self._laske_joukko):
+      arvot = self._laske_joukko(rivit)
+      jaljella = []
+      for rivi in rivit:
+        if (arvo := arvot.get(rivi.pk)) is EI_ASETETTU:
+          jaljella.append(rivi)
+        else:
+          rivi.__dict__[attname] = getattr(arvo, 'pk', arvo)
+      if len(jaljella) < len(rivit):
+        seuranta.kirjaa(self, 'laske')
+      rivit = jaljella
+      # if rivit
+    if rivit:
+      qs = rivit[0].__class__._base_manager.db_manager(
+        None, hints={'instance': rivit[0]}
+      )
+      alku = time.perf_counter()
+      arvot = self._kysy_kannasta(qs, rivit)
+      seuranta.kirjaa_kantakysely(self, time.perf_counter() - alku, len(rivit))
+      for rivi in rivit:
+        rivi.__dict__[attname] = arvot.get(rivi.pk)
+      # if rivit
+    # def laske_rivit
+
+  def _kysy_kannasta(self, qs, rivit, select_related=False):
+    '''
+    Kysy kentän arvot annetuille riveille kannasta `pk__in`-ehdolla.
+
+    Rivit jaetaan tarvittaessa useaan kyselyyn tietokannan
+    parametrirajoitusten mukaisesti (vrt. `Collector`).
+
+    Palauttaa sanakirjan `pk -> arvo`; parametrillä `select_related=True`
+    arvona on viitattu rivi (tai `None`), joka haetaan samassa kyselyssä
+    lumekentän kautta liittäen (ks. `get_extra_restriction`).
+    '''
+    # pylint: disable=protected-access
+    pk = self.model._meta.pk
+    koko = max(connections[qs.db].ops.bulk_batch_size([pk], rivit), 1)
+    arvot = {}
+    for alku in range(0, len(rivit), koko):
+      osa = qs.filter(pk__in=[rivi.pk for rivi in rivit[alku:alku + koko]])
+      if select_related:
+        arvot.update(
+          (rivi.pk, getattr(rivi, self.name))
+          for rivi in osa.select_related(self.name).only('pk', self.name)
+        )
+      else:
+        arvot.update(osa.values_list('pk', self.get_attname()))
+    return arvot
+    # def _kysy_kannasta
 
   def aseta_paikallisesti(self, rivi, arvo):
     '''
@@ -170,6 +474,8 @@ class Lumekentta(models.fields.Field):
 
   def get_col(self, alias, output_field=None):
     # Ks. `Field.get_col`.
+    if self.tallennettu:
+      return super().get_col(alias, output_field)
     if output_field is None:
       if isinstance(self, models.ForeignKey):
         # Ks. `ForeignKey.get_col`.
@@ -190,6 +496,8 @@ class Lumekentta(models.fields.Field):
 
   @cached_property
   def cached_col(self):
+    if self.tallennettu:
+      return models.expressions.Col(self.model._meta.db_table, self)
     return Lumesarake(self.model._meta.db_table, self)
     # def cached_col
 
@@ -197,12 +505,16 @@ class Lumekentta(models.fields.Field):
   def get_joining_columns(self, reverse_join=False):
     ''' Ohita normaali JOIN-ehto (`a`.`id` = `b`.`a_id`) '''
     # pylint: disable=unused-argument
+    if self.tallennettu:
+      return super().get_joining_columns(reverse_join)
     return tuple()
     # def get_joining_columns
 
   def get_joining_fields(self, reverse_join=False):
     ''' Ohita normaali JOIN-ehto (`a`.`id` = `b`.`a_id`) '''
     # pylint: disable=unused-argument
+    if self.tallennettu:
+      return super().get_joining_fields(reverse_join)
     return tuple()
     # def get_joining_columns
 
@@ -213,6 +525,8 @@ class Lumekentta(models.fields.Field):
     Tätä kutsutaan vain `ForeignObject`-tyyppiselle kentälle.
     '''
     # pylint: disable=unused-argument, no-member
+    if self.tallennettu:
+      return super().get_extra_restriction(alias, related_alias)
     rhs_field = self.related_fields[0][1]
     field = rhs_field.model._meta.get_field(rhs_field.column)
     return field.get_lookup('exact')(
@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+
+import contextlib
+
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist
+from django.db import models
+from django.db.models.sql.datastructures import Join
+
+
+AVAIN, ARVO, JARJESTYS = 'lume_avain', 'lume_arvo', 'lume_jarjestys'
+
+
+def _korrelaatio(kentta, query):
+  '''
+  Poimi kyselyn ainoa `y=OuterRef(...)`-ehto ja sitä vastaava ulomman
+  mallin kenttä; tai `None`.
+  '''
+  if query.where.negated \
+  or query.where.connector != models.sql.where.AND \
+  or query.combinator \
+  or query.distinct:
+    return None
+  ehdot = [
+    ehto for ehto in query.where.children
+    if isinstance(getattr(ehto, 'rhs', None), (
+      models.expressions.ResolvedOuterRef,
+      models.OuterRef,
+    ))
+  ]
+  if len(ehdot) != 1 \
+  or ehdot[0].lookup_name != 'exact' \
+  or not isinstance(ehdot[0].lhs, models.expressions.Col):
+    return None
+  ehto, = ehdot
+  try:
+    ulompi = kentta.model._meta.pk if ehto.rhs.name == 'pk' \
+      else kentta.model._meta.get_field(ehto.rhs.name)
+  except FieldDoesNotExist:
+    return None
+  if not ulompi.concrete:
+    return None
+  return ehto, ulompi
+  # def _korrelaatio
+
+
+def ryhmitelty_kysely(kentta):
+  '''
+  Tunnista lumekentän kyselystä jokin muodoista
+
+    Subquery(
+      X.objects.filter(y=OuterRef('pk')).values('y').values(a=Sum(...))
+    )
+    Subquery(
+      X.objects.filter(y=OuterRef('pk')).order_by(...).values('pk')[:1]
+    )
+
+  ja muodosta vastaava, koko taulun kattava kysely, joka palauttaa
+  sarakkeet `AVAIN` (korrelaatioavain) ja `ARVO`, esim.
+  `X.objects.values(AVAIN=y).annotate(ARVO=Sum(...))`.
+
+  Jälkimmäisessä (top-1) muodossa kysely palauttaa lisäksi sarakkeen
+  `JARJESTYS` = `ROW_NUMBER() OVER (PARTITION BY y ORDER BY ...)`.
+
+  Palauttaa kolmikon (kysely, ulomman mallin kenttä, ikkunafunktio)
+  tai `None`. Tulos tallennetaan kentälle kyselyversion mukaan.
+  '''
+  tallennettu = kentta.__dict__.get('_ryhmitelty_kysely')
+  if tallennettu is not None and tallennettu[0] == kentta.kyselyversio:
+    return tallennettu[1]
+  tulos = None
+  kysely = kentta.kysely
+  query = getattr(kysely, 'query', None)
+  if isinstance(kysely, models.Subquery) \
+  and query is not None \
+  and (korrelaatio := _korrelaatio(kentta, query)) is not None:
+    ehto, ulompi = korrelaatio
+    # Koostefunktio korrelaatioavaimen mukaan ryhmiteltynä.
+    if not query.is_sliced \
+    and len(query.annotation_select) == 1 \
+    and next(iter(query.annotation_select.values())).contains_aggregate \
+    and isinstance(query.group_by, tuple) \
+    and len(query.group_by) == 1 \
+    and isinstance(query.group_by[0], models.expressions.Col) \
+    and (query.group_by[0].alias, query.group_by[0].target) \
+    == (ehto.lhs.alias, ehto.lhs.target):
+      arvo, = query.annotation_select.values()
+      query = query.clone()
+      query.where.children.remove(ehto)
+      query.clear_select_clause()
+      query.clear_ordering(force=True)
+      query.group_by = None
+      tulos = (
+        models.QuerySet(model=query.model, query=query).values(
+          **{AVAIN: ehto.lhs},
+        ).annotate(**{ARVO: arvo}).order_by(),
+        ulompi,
+        False,
+      )
+    # Järjestyksessä ensimmäinen rivi.
+    elif query.low_mark == 0 \
+    and query.high_mark == 1 \
+    and query.group_by is None \
+    and not query.annotation_select \
+    and len(query.select) == 1 \
+    and (jarjestys := query.order_by or query.get_meta().ordering):
+      arvo, = query.select
+      query = query.clone()
+      query.where.children.remove(ehto)
+      query.clear_select_clause()
+      query.clear_limits()
+      query.clear_ordering(force=True)
+      tulos = (
+        models.QuerySet(model=query.model, query=query).values(**{
+          AVAIN: ehto.lhs,
+          ARVO: arvo,
+          JARJESTYS: models.Window(
+            models.functions.RowNumber(),
+            partition_by=[ehto.lhs],
+            order_by=list(jarjestys),
+          ),
+        }),
+        ulompi,
+        True,
+      )
+  kentta.__dict__['_ryhmitelty_kysely'] = (kentta.kyselyversio, tulos)
+  return tulos
+  # def ryhmitelty_kysely
+
+
+def kayta_liitosta(kentta, compiler, alias=None):
+  '''
+  Valitse, lasketaanko kentän arvo tässä kyselyssä ryhmitellyn
+  liitoksen avulla.
+
+  Liitosta käytetään, kun
+  - kentälle on määritetty `strategia='liitos'`;
+  - kyselyn FROM-lauseketta ei ole vielä muodostettu (SELECT- ja
+    ORDER BY -lausekkeet) tai taulun `alias` liitos on jo lisätty
+    kyselyyn (ks. `liita`);
+  - kyselyä ei ole rajattu pienempään määrään rivejä kuin
+    `LUME_LIITOS_RAJA` (oletus 50); ja
+  - kentän kysely on tunnistettavaa muotoa (ks. `ryhmitelty_kysely`); ja
+  - ikkunafunktiota edellyttävän muodon tapauksessa tietokanta tukee
+    ikkunafunktioita.
+  '''
+  # pylint: disable=import-outside-toplevel
+  from django.db.models.sql.compiler import SQLCompiler
+  if kentta.strategia != 'liitos' \
+  or type(compiler) is not SQLCompiler:
+    return False
+  if getattr(compiler, 'lume_from_valmis', False):
+    return (kentta, alias) in getattr(compiler, 'lume_liitokset', {})
+  query = compiler.query
+  # Sivutettu kysely (ks. `kaantaja.sivutus`) on rajattu sisemmässä
+  # kyselyssä.
+  rivimaara = getattr(query, 'lume_rivimaara', None)
+  if rivimaara is None and query.high_mark is not None:
+    rivimaara = query.high_mark - query.low_mark
+  if rivimaara is not None \
+  and rivimaara < getattr(settings, 'LUME_LIITOS_RAJA', 50):
+    return False
+  if (tulos := ryhmitelty_kysely(kentta)) is None:
+    return False
+  return not tulos[2] or compiler.connection.features.supports_over_clause
+  # def kayta_liitosta
+
+
+class Ryhmaliitos(Join):
+  '''
+  LEFT OUTER JOIN -liitos lumekentän ryhmiteltyyn kyselyyn
+  (ks. `ryhmitelty_kysely`).
+
+  Kenttä annetaan `join_field`-parametrinä.
+  '''
+  # pylint: disable=abstract-method
+
+  def as_sql(self, compiler, connection):
+    kysely, ulompi, ikkuna = ryhmitelty_kysely(self.join_field)
+    sql, params = kysely.query.get_compiler(
+      connection=connection
+    ).as_sql()
+    qn = compiler.quote_name_unless_alias
+    qn2 = connection.ops.quote_name
+    ehto = '%s.%s = %s.%s' % (
+      qn2(self.table_alias),
+      qn2(AVAIN),
+      qn(self.parent_alias),
+      qn2(ulompi.column),
+    )
+    if ikkuna:
+      ehto += ' AND %s.%s = 1' % (qn2(self.table_alias), qn2(JARJESTYS))
+    return (
+      '%s (%s) %s ON (%s)' % (
+        self.join_type, sql, qn2(self.table_alias), ehto,
+      ),
+      params,
+    )
+    # def as_sql
+
+  # class Ryhmaliitos
+
+
+def jarjesta_viittaukset(compiler):
+  '''
+  Lisää ryhmitelty liitos kullekin lumeviittauksen (esim.
+  `select_related('pisin_osoite')`) liitokselle, jotta viitattu
+  taulu voidaan liittää suoraan lasketun avaimen mukaan
+  (`ON "x"."id" = "liitos"."lume_arvo"`) korreloidun alikyselyn sijaan.
+  Ks. `lisaa_liitokset`.
+
+  Kutsutaan ennen FROM-lausekkeen muodostamista.
+  '''
+  # pylint: disable=import-outside-toplevel
+  from .kentta import Lumekentta
+  query = compiler.query
+  for alias, join in query.alias_map.items():
+    kentta = getattr(join, 'join_field', None)
+    if isinstance(kentta, Lumekentta) \
+    and not kentta.tallennettu \
+    and query.alias_refcount[alias] \
+    and kayta_liitosta(kentta, compiler):
+      liita(kentta, compiler, join.parent_alias)
+  # def jarjesta_viittaukset
+
+
+@contextlib.contextmanager
+def lisaa_liitokset(compiler):
+  '''
+  Lisää kääntäjän ryhmitellyt liitokset kyselyn tauluihin FROM-lausekkeen
+  muodostamisen ajaksi: kukin sitä käyttävän lumeviittauksen liitoksen
+  edelle, muut loppuun.
+
+  Liitoksia ei jätetä kyselyyn, sillä `Ryhmaliitos` ei ole tavallinen
+  viittausliitos (esim. `Query.resolve_expression` edellyttää, että
+  liitoksen kentällä on `related_model`); kysely voi myös olla kutsujan
+  oma, edelleen käytettävä ja kloonattava kysely.
+  '''
+  liitokset = getattr(compiler, 'lume_liitokset', None)
+  if not liitokset:
+    yield
+    return
+  query = compiler.query
+  alkuperainen = query.alias_map
+  alias_map = {}
+  for alias, join in alkuperainen.items():
+    if (
+      ryhmaliitos := liitokset.get(
+        (getattr(join, 'join_field', None), join.parent_alias)
+      )
+    ) is not None and isinstance(join, Join):
+      alias_map[ryhmaliitos.table_alias] = ryhmaliitos
+    alias_map[alias] = join
+  for ryhmaliitos in liitokset.values():
+    alias_map.setdefault(ryhmaliitos.table_alias, ryhmaliitos)
+  lisatyt = [
+    ryhmaliitos.table_alias for ryhmaliitos in liitokset.values()
+    if ryhmaliitos.table_alias not in query.alias_refcount
+  ]
+  query.alias_map = alias_map
+  query.alias_refcount.update((alias, 1) for alias in lisatyt)
+  try:
+    yield
+  finally:
+    query.alias_map = alkuperainen
+    for alias in lisatyt:
+      del query.alias_refcount[alias]
+  # def lisaa_liitokset
+
+
+def liita(kentta, compiler, parent_alias):
+  '''
+  Lisää (tai käytä uudelleen) ryhmitelty liitos ja palauta sen alias.
+
+  Liitokset kirjataan kääntäjälle (`compiler.lume_liitokset`) eikä
+  kyselyyn; ne lisätään FROM-lausekkeeseen (ks. `lisaa_liitokset`).
+  '''
+  liitokset = compiler.__dict__.setdefault('lume_liitokset', {})
+  try:
+    return liitokset[kentta, parent_alias].table_alias
+  except KeyError:
+    pass
+  nimi = f'{kentta.model._meta.db_table}__{kentta.name}'
+  varatut = {
+    *compiler.query.alias_map,
+    *compiler.query.table_map,
+    *(ryhmaliitos.table_alias for ryhmaliitos in liitokset.values()),
+  }
+  alias, jarjestys = nimi, 1
+  while alias in varatut:
+    jarjestys += 1
+    alias = f'{nimi}_{jarjestys}'
+  liitokset[kentta, parent_alias] = Ryhmaliitos(
+    nimi,
+    parent_alias,
+    alias,
+    models.sql.constants.LOUTER,
+    kentta,
+    True,
+  )
+  return alias
+  # def liita
@@ -14,6 +14,9 @@ class Lumemaare(models.query_utils.DeferredAttribute):
     '''
     if instance is None:
       return self
+    if self.field.tallennettu:
+      # Tallennettu kenttä: luetaan sarake kannasta tavalliseen tapaan.
+      return super().__get__(instance, cls)
     data = instance.__dict__
     field_name = self.field.get_attname()
     if data.get(field_name, self) is self:
@@ -63,6 +66,29 @@ class Lumemaare(models.query_utils.DeferredAttribute):
 
 
 class LumeFM2OMaare:
+  def __get__(self, instance, cls=None):
+    '''
+    Kysyttäessä viittausta, jonka avainta ei ole vielä laskettu, haetaan
+    viitattu rivi suoraan `laske_paikallisesti(select_related=True)`-kutsun
+    avulla (yhdellä kantakyselyllä) ja asetetaan se välimuistiin.
+
+    Vrt. ForwardManyToOneDescriptor.__get__.
+    '''
+    # pylint: disable=no-member
+    kentta = self.field
+    if instance is not None \
+    and not kentta.tallennettu \
+    and kentta.get_attname() not in instance.__dict__ \
+    and not kentta.is_cached(instance):
+      tulos = kentta.laske_paikallisesti(instance, select_related=True)
+      if isinstance(tulos, kentta.related_model):
+        instance.__dict__[kentta.get_attname()] = tulos.pk
+        kentta.set_cached_value(instance, tulos)
+      else:
+        instance.__dict__[kentta.get_attname()] = tulos
+    return super().__get__(instance, cls)
+    # def __get__
+
   def get_object(self, instance):
     '''
     Kysyttäessä viittausta toiseen malliin, jota ei ole välimuistissa,
@@ -74,6 +100,9 @@ class LumeFM2OMaare:
     # pylint: disable=no-member
     # Huomaa, että `self.field` asetetaan kaikille kenttätyyppikohtaisille
     # Django-kuvaajille, joista käsillä oleva luokka voidaan periyttää.
+    # Mikäli viitatun rivin avain on jo laskettu, haetaan rivi sen mukaan.
+    if self.field.get_attname() in instance.__dict__:
+      return super().get_object(instance)
     tulos = self.field.laske_paikallisesti(
       instance,
       select_related=True,
@@ -84,4 +113,24 @@ class LumeFM2OMaare:
     else:
       return super().get_object(instance)
     # def get_object
+
+  def get_prefetch_querysets(self, instances, querysets=None):
+    '''
+    Laske viitattujen rivien avaimet kaikille riveille kerralla
+    (`Lumekentta.laske_rivit`) ennen rivien hakua (`prefetch_related`).
+
+    Vrt. ForwardManyToOneDescriptor.get_prefetch_querysets.
+    '''
+    # pylint: disable=no-member
+    self.field.laske_rivit(instances)
+    return super().get_prefetch_querysets(instances, querysets)
+    # def get_prefetch_querysets
+
+  # Django 4.2.
+  def get_prefetch_queryset(self, instances, queryset=None):
+    # pylint: disable=no-member
+    self.field.laske_rivit(instances)
+    return super().get_prefetch_queryset(instances, queryset)
+    # def get_prefetch_queryset
+
   # class LumeFM2OMaare
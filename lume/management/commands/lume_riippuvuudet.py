@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+
+from lume.riippuvuus import riippuvuusgraafi
+
+
+class Command(BaseCommand):
+  help = 'Tulosta lumekenttien riippuvuusgraafi.'
+
+  def add_arguments(self, parser):
+    parser.add_argument(
+      'mallit', nargs='*', metavar='sovellus.Malli',
+      help='Käsiteltävät mallit (oletuksena kaikki).',
+    )
+    parser.add_argument(
+      '--suorat', action='store_true',
+      help='Tulosta vain välittömät riippuvuudet.',
+    )
+    # def add_arguments
+
+  def handle(self, *args, **options):
+    try:
+      mallit = [
+        apps.get_model(nimi) for nimi in options['mallit']
+      ] or None
+    except (LookupError, ValueError) as exc:
+      raise CommandError(str(exc)) from exc
+    graafi = riippuvuusgraafi(
+      mallit, transitiivinen=not options['suorat']
+    )
+    for kentta, riippuvuudet in graafi.items():
+      self.stdout.write(f'{kentta.model._meta.label}.{kentta.name}')
+      for riippuvuus in sorted(
+        f'{riippuvuus.model._meta.label}.{riippuvuus.name}'
+        for riippuvuus in riippuvuudet
+      ):
+        self.stdout.write(f'  {riippuvuus}')
+    # def handle
+
+  # class Command
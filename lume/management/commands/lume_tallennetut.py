@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, models, transaction
+
+from lume.tallennettu import paivita, tallennetut_kentat, vaikutuspolut
+
+
+class Command(BaseCommand):
+  help = (
+    'Laske tallennetut lumekentät uudelleen tai tarkista niiden arvot.'
+  )
+
+  def add_arguments(self, parser):
+    parser.add_argument(
+      'kentat', nargs='*', metavar='sovellus.Malli.kentta',
+      help='Käsiteltävät kentät (oletuksena kaikki).',
+    )
+    parser.add_argument(
+      '--tarkista', action='store_true',
+      help='Vertaa tallennettuja arvoja laskettuihin muuttamatta niitä.',
+    )
+    parser.add_argument(
+      '--eran-koko', type=int, default=1000,
+      help='Kerralla käsiteltävien rivien määrä (oletus 1000).',
+    )
+    parser.add_argument(
+      '--database', default=DEFAULT_DB_ALIAS,
+    )
+    # def add_arguments
+
+  def _kentat(self, nimet):
+    kentat = {
+      f'{kentta.model._meta.label}.{kentta.name}': kentta
+      for kentta in tallennetut_kentat()
+    }
+    if not nimet:
+      return list(kentat.values())
+    try:
+      return [kentat[nimi] for nimi in nimet]
+    except KeyError as exc:
+      raise CommandError(f'Tuntematon tallennettu kenttä: {exc}') from exc
+    # def _kentat
+
+  def handle(self, *args, **options):
+    # pylint: disable=protected-access
+    using = options['database']
+    virheita = 0
+    for kentta in self._kentat(options['kentat']):
+      avain = vaikutuspolut(kentta)[0]
+      qs = kentta.model._base_manager.db_manager(using).order_by(avain)
+      avaimet = list(qs.values_list(avain, flat=True).distinct())
+      for alku in range(0, len(avaimet), options['eran_koko']):
+        era = avaimet[alku:alku + options['eran_koko']]
+        if options['tarkista']:
+          poikkeavat = qs.filter(**{f'{avain}__in': era}).alias(
+            lume_laskettu=kentta.kysely,
+          ).exclude(
+            **{kentta.attname: models.F('lume_laskettu')},
+          ).exclude(
+            **{f'{kentta.attname}__isnull': True, 'lume_laskettu': None},
+          ).values_list('pk', flat=True)
+          for pk in poikkeavat:
+            virheita += 1
+            self.stderr.write(f'{kentta.model._meta.label}({pk}).{kentta.name}')
+        else:
+          with transaction.atomic(using=using):
+            paivita(kentta, era, using=using)
+      if not options['tarkista']:
+        self.stdout.write(
+          f'{kentta.model._meta.label}.{kentta.name}: {len(avaimet)} riviä.'
+        )
+    if virheita:
+      raise CommandError(f'{virheita} poikkeavaa arvoa.')
+    # def handle
+
+  # class Command
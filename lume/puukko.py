@@ -3,57 +3,91 @@
 # pylint: disable=invalid-name, protected-access, unused-argument
 
 from contextlib import contextmanager
+from contextvars import ContextVar
 import functools
 import itertools
+import threading
+import weakref
 
 from django.db.migrations import autodetector
-from django.db import models
+from django.db.migrations.state import ModelState
+from django.db import models, transaction
+from django.db.models.deletion import Collector
 from django.db.models.options import Options
+from django.db.models.sql.compiler import SQLCompiler
+from django.utils.functional import cached_property
 
+from .kaantaja import sivutus, yhteiset_alilausekkeet
 from .kentta import Lumekentta
+from .sarake import SQLValimuisti
+from . import arvovalimuisti, asynkroninen, liitos, tallennettu
+
+
+_puukot = []
+_asennettu = False
+_lukko = threading.Lock()
 
 
 def puukota(moduuli, koriste=None, kopioi=None):
   '''
   Korvaa moduulissa olevan metodin tai lisää uuden (`kopioi`).
+
+  Korvaus kirjataan ja tehdään vasta `asenna()`-kutsulla.
   '''
   def puukko(funktio):
-    toteutus = getattr(moduuli, kopioi or funktio.__name__)
-    def uusi_toteutus(*args, **kwargs):
-      return funktio(toteutus, *args, **kwargs)
-    setattr(
-      moduuli, funktio.__name__,
-      (koriste or functools.wraps(toteutus))(uusi_toteutus)
-    )
+    def _asenna():
+      toteutus = getattr(moduuli, kopioi or funktio.__name__)
+      def uusi_toteutus(*args, **kwargs):
+        return funktio(toteutus, *args, **kwargs)
+      uusi = (koriste or functools.wraps(toteutus))(uusi_toteutus)
+      setattr(moduuli, funktio.__name__, uusi)
+      # Esim. `cached_property` tarvitsee nimensä.
+      if hasattr(uusi, '__set_name__'):
+        uusi.__set_name__(moduuli, funktio.__name__)
+    _puukot.append(_asenna)
   return puukko
   # def puukota
 
 
+@puukota(ModelState, koriste=classmethod)
+def from_model(oletus, cls, model, exclude_rels=False):
+  '''
+  Jätä tallentamattomat lumekentät pois mallin tilasta jo sitä
+  muodostettaessa (ks. `LocalFields`): niitä ei tällöin kloonata
+  eikä niiden kyselyä muodosteta, eikä muutostunnistus näe niitä.
+  '''
+  with _ohita_lumekentat():
+    return oletus.__func__(cls, model, exclude_rels=exclude_rels)
+  # def from_model
+
+
 @puukota(autodetector.MigrationAutodetector)
 def __init__(oletus, self, *args, **kwargs):
   '''
-  Poista lumekentät migraatioiden luonnin yhteydessä
-  sekä vanhojen että uusien kenttien listalta.
+  Poista lumekentät migraatioiden luonnin yhteydessä vanhojen kenttien
+  listalta, mikäli aiemmat migraatiot sisältävät niitä. Uusi tila
+  muodostetaan malleista ilman lumekenttiä (ks. `from_model` yllä).
   '''
   oletus(self, *args, **kwargs)
   for malli in self.from_state.models.values():
-    malli.fields = {
-      l: f for l, f in malli.fields.items() if not isinstance(f, Lumekentta)
-    }
-  for malli in self.to_state.models.values():
-    malli.fields = {
-      l: f for l, f in malli.fields.items() if not isinstance(f, Lumekentta)
-    }
+    if any(isinstance(f, Lumekentta) for f in malli.fields.values()):
+      malli.fields = {
+        l: f for l, f in malli.fields.items()
+        if not isinstance(f, Lumekentta)
+      }
   # def __init__
 
 
-@puukota(Options, koriste=property)
+@puukota(Options, koriste=cached_property)
 def concrete_fields(oletus, self):
   '''
   Järjestä lumekentät viimeisiksi.
 
   Tätä tarvitaan uutta riviä luotaessa, jotta todellisten
   sarakkeiden arvot ovat käytettävissä lumekenttiä asetettaessa.
+
+  Arvo tallennetaan välimuistiin Djangon oman toteutuksen tapaan;
+  `Options._expire_cache` tyhjentää sen (`FORWARD_PROPERTIES`).
   '''
   return models.options.make_immutable_fields_list(
     "concrete_fields", itertools.chain((
@@ -67,10 +101,12 @@ def concrete_fields(oletus, self):
   # def concrete_fields
 
 
-@puukota(Options, koriste=property)
+@puukota(Options, koriste=cached_property)
 def local_concrete_fields(oletus, self):
   '''
   Ohita lumekentät mallin konkreettisia kenttiä kysyttäessä.
+
+  Arvo tallennetaan välimuistiin kuten `concrete_fields` yllä.
   '''
   return models.options.make_immutable_fields_list(
     "local_concrete_fields", (
@@ -92,6 +128,156 @@ def _insert(oletus, self, objs, fields, **kwargs):
   # def _insert
 
 
+@puukota(models.query.QuerySet)
+def update(oletus, self, **kwargs):
+  '''
+  Päivitä muutettujen rivien vaikutuspiirissä olevat tallennetut
+  lumekentät (ks. `tallennettu.py`) ja vanhenna välimuistiin tallennetut
+  (ks. `arvovalimuisti.py`). Tätä käyttää myös `bulk_update`.
+  '''
+  if self.model not in tallennettu._riippuvuuskartta():
+    tulos = oletus(self, **kwargs)
+  else:
+    with transaction.atomic(using=self.db, savepoint=False):
+      ennen = tallennettu.vaikutukset(self.model, self, self.db)
+      pks = list(self.order_by().values_list('pk', flat=True))
+      tulos = oletus(self, **kwargs)
+      tallennettu.paivita_vaikutukset(tallennettu.yhdista(
+        ennen, tallennettu.vaikutukset(self.model, pks, self.db),
+      ), using=self.db)
+  # Vanhennetaan vain muuttuneista riveistä riippuvat arvot.
+  if tulos:
+    for kentta in arvovalimuisti.riippuvat_kentat(self.model):
+      arvovalimuisti.mitatoi(kentta)
+  return tulos
+  # def update
+
+
+@puukota(models.query.QuerySet)
+def bulk_create(oletus, self, objs, *args, **kwargs):
+  '''
+  Päivitä luotujen rivien vaikutuspiirissä olevat tallennetut lumekentät
+  (ks. `tallennettu.py`); `bulk_create` ei lähetä tallennussignaaleja.
+
+  Mikäli luotujen rivien avaimia ei saada (tietokanta ei palauta niitä)
+  tai olemassa olevia rivejä päivitetään (`update_conflicts`), kentän
+  kaikki rivit päivitetään.
+  '''
+  if self.model not in tallennettu._riippuvuuskartta():
+    return oletus(self, objs, *args, **kwargs)
+  with transaction.atomic(using=self.db, savepoint=False):
+    tulos = oletus(self, objs, *args, **kwargs)
+    pks = [obj.pk for obj in tulos]
+    vaikutus = tallennettu.vaikutukset(
+      self.model, [pk for pk in pks if pk is not None], self.db
+    )
+    if None in pks or kwargs.get('update_conflicts'):
+      vaikutus = dict.fromkeys(vaikutus)
+    tallennettu.paivita_vaikutukset(vaikutus, using=self.db)
+  return tulos
+  # def bulk_create
+
+
+@puukota(models.query.ModelIterable)
+def __iter__(oletus, self):
+  '''
+  Kirjaa saman kyselyn palauttamat lumekentällisen mallin rivit toistensa
+  sisaruksiksi. Kun jonkin rivin lumekenttä joudutaan kysymään erikseen
+  kannasta, haetaan se yhdellä kertaa kaikille sisaruksille.
+
+  Kyselyn mukana haetut, välimuistia käyttävien lumekenttien arvot
+  tallennetaan välimuistiin (ks. `arvovalimuisti.py`).
+
+  Paloittain luettavan kyselyn (`.iterator()`) rivit kirjataan
+  sisaruksiksi ja välimuistiin palakohtaisesti (`chunk_size`).
+  '''
+  if not any(
+    isinstance(f, Lumekentta)
+    for f in self.queryset.model._meta.concrete_fields
+  ):
+    yield from oletus(self)
+    return
+  # Versionumerot luetaan ennen kyselyn suoritusta.
+  versiot = {
+    kentta: arvovalimuisti.versio(kentta)
+    for kentta in self.queryset.model._meta.concrete_fields
+    if arvovalimuisti.kaytossa(kentta)
+  }
+  arvot = {kentta: {} for kentta in versiot}
+  sisarukset = []
+
+  def tallenna():
+    for kentta, _arvot in arvot.items():
+      arvovalimuisti.tallenna(kentta, versiot[kentta], _arvot)
+      _arvot.clear()
+
+  try:
+    for rivi in oletus(self):
+      if self.chunked_fetch and len(sisarukset) >= self.chunk_size:
+        sisarukset = []
+        tallenna()
+      rivi._state.lume_sisarukset = sisarukset
+      sisarukset.append(weakref.ref(rivi))
+      for kentta, _arvot in arvot.items():
+        if kentta.attname in rivi.__dict__:
+          _arvot[rivi.pk] = rivi.__dict__[kentta.attname]
+      yield rivi
+  finally:
+    tallenna()
+  # def __iter__
+
+
+@puukota(models.base.ModelState)
+def __getstate__(oletus, self):
+  '''
+  Jätä sisarusrekisteri (heikot viittaukset) pois säilöttävästä tilasta.
+  '''
+  state = oletus(self)
+  state.pop('lume_sisarukset', None)
+  return state
+  # def __getstate__
+
+
+@puukota(SQLCompiler)
+def as_sql(oletus, self, with_limits=True, with_col_aliases=False):
+  '''
+  Laske lumekentät rajatussa kyselyssä vain sivun riveille ja
+  toisistaan riippuvat lumekentät vain kerran kyselyä kohti.
+
+  Ks. `kaantaja.sivutus` ja `kaantaja.yhteiset_alilausekkeet`.
+  '''
+  self.lume_from_valmis = False
+  self.lume_liitokset = {}
+  sql, params = oletus(
+    self, with_limits=with_limits, with_col_aliases=with_col_aliases
+  )
+  if type(self) is not SQLCompiler or with_col_aliases:
+    return sql, params
+  if with_limits and (tulos := sivutus(self)):
+    return tulos
+  if (tulos := yhteiset_alilausekkeet(self, with_limits=with_limits)):
+    return tulos
+  return sql, params
+  # def as_sql
+
+
+@puukota(SQLCompiler)
+def get_from_clause(oletus, self):
+  '''
+  Merkitse FROM-lauseke muodostetuksi; tämän jälkeen (WHERE, HAVING)
+  lumekentille ei voida lisätä uusia liitoksia (ks. `liitos.py`).
+
+  Ryhmitellyt liitokset lisätään FROM-lausekkeeseen vain sen
+  muodostamisen ajaksi; lumeviittausten liitokset muodostetaan niiden
+  kautta, mikäli mahdollista (ks. `liitos.jarjesta_viittaukset`).
+  '''
+  liitos.jarjesta_viittaukset(self)
+  self.lume_from_valmis = True
+  with liitos.lisaa_liitokset(self):
+    return oletus(self)
+  # def get_from_clause
+
+
 @puukota(models.query.QuerySet, kopioi='only')
 def lume(only, self, *fields):
   '''
@@ -115,7 +301,14 @@ def lume(only, self, *fields):
 # jo kutsuttu, joten kopioidaan `lume`-metodi käsin `Manager`-luokkaan:
 def m_lume(self, *args, **kwargs):
   return getattr(self.get_queryset(), 'lume')(*args, **kwargs)
-models.Manager.lume = m_lume
+
+
+async def alume(self, *kentat):
+  '''
+  Täytä rivin (ja sen sisarusrivien) puuttuvat lumekentät
+  asynkronisesti; ks. `asynkroninen.alume`.
+  '''
+  return await asynkroninen.alume(self, *kentat)
 
 
 @puukota(models.sql.query.Query, kopioi='clear_deferred_loading')
@@ -132,12 +325,68 @@ def lisaa_lumekentat(oletus, self, kentat):
   # def lisaa_lumekentat
 
 
+def _jaadyta(select_related):
+  ''' `select_related`-rakenne hajautettavassa muodossa. '''
+  if isinstance(select_related, dict):
+    return tuple(sorted(
+      (nimi, _jaadyta(alirakenne))
+      for nimi, alirakenne in select_related.items()
+    ))
+  return select_related
+  # def _jaadyta
+
+
+def _kopioi_maski(select_mask):
+  ''' Valintamaskin (sisäkkäiset sanakirjat) syväkopio. '''
+  return {
+    kentta: _kopioi_maski(alimaski)
+    for kentta, alimaski in select_mask.items()
+  }
+  # def _kopioi_maski
+
+
+# Valintamaskit (ks. `get_select_mask`) mallin, pyydettyjen lumekenttien
+# ja `select_related`-rakenteen mukaan. Tyhjennetään, mikäli lumekenttien
+# `automaattinen`-määritystä muutetaan ajon aikana.
+maskit = SQLValimuisti()
+
+
 @puukota(models.sql.query.Query)
 def get_select_mask(oletus, self):
+  '''
+  Muodosta valintamaski lumekentät huomioiden (ks. alla)
+  tai hae se välimuistista.
+
+  Välimuistiin tallennettua maskia ei luovuteta kutsujalle sellaisenaan,
+  vaan kukin kutsuja saa siitä oman kopionsa.
+  '''
+  avain = (
+    self.model,
+    frozenset(self.deferred_loading[0]),
+    self.deferred_loading[1],
+    frozenset(getattr(self, 'pyydetyt_lumekentat', ())),
+    _jaadyta(self.select_related),
+    tuple(
+      (nimi, suhde.relation_name)
+      for nimi, suhde in sorted(self._filtered_relations.items())
+    ),
+    getattr(self, 'lume_karsittu', False),
+  ) if maskit.koko else None
+  if avain is not None and (select_mask := maskit.hae(avain)) is not None:
+    return _kopioi_maski(select_mask)
   field_names, defer = self.deferred_loading
   if not field_names and defer:
-    return self._get_defer_select_mask(self.get_meta(), {})
-  return oletus(self)
+    select_mask = self._get_defer_select_mask(self.get_meta(), {})
+  else:
+    select_mask = oletus(self)
+    if not defer and getattr(self, 'lume_karsittu', False):
+      # Ks. `karsi_lumekentat`; `only()`-maskiin sisältyy aina perusavain.
+      for kentta in list(select_mask):
+        if isinstance(kentta, Lumekentta) and not kentta.tallennettu:
+          del select_mask[kentta]
+  if avain is not None:
+    maskit.tallenna(avain, _kopioi_maski(select_mask))
+  return select_mask
   # def get_select_mask
 
 @puukota(models.sql.query.Query)
@@ -148,7 +397,10 @@ def _get_defer_select_mask(oletus, self, opts, mask, select_mask=None):
   if select_mask is None:
     select_mask = {}
 
-  for pyydetty_lumekentta in getattr(self, 'pyydetyt_lumekentat', ()):
+  karsittu = getattr(self, 'lume_karsittu', False)
+  for pyydetty_lumekentta in (
+    () if karsittu else getattr(self, 'pyydetyt_lumekentat', ())
+  ):
     _opts, _select_mask = opts, select_mask
     for fn in pyydetty_lumekentta.split(models.sql.query.LOOKUP_SEP):
       kentta = _opts.get_field(fn)
@@ -169,7 +421,9 @@ def _get_defer_select_mask(oletus, self, opts, mask, select_mask=None):
           _select_related,
         ):
           mask.pop(kentta.name)
-      elif isinstance(kentta, Lumekentta) and not kentta.automaattinen:
+      elif isinstance(kentta, Lumekentta) \
+      and not kentta.tallennettu \
+      and (karsittu or not kentta.automaattinen):
         mask.setdefault(kentta.name, {})
     return mask
     # def taydenna_maski
@@ -179,15 +433,68 @@ def _get_defer_select_mask(oletus, self, opts, mask, select_mask=None):
   # def _get_defer_select_mask
 
 
-__get_deferred_fields_ohita = False
+def karsi_lumekentat(query):
+  '''
+  Jätä (tallentamattomat) lumekentät pois kyselyn malliriveistä
+  riippumatta `automaattinen`-, `lume()`- ja `only()`-määrityksistä.
+
+  Käytetään kyselyissä, joiden tulosta ei palauteta kutsuvalle koodille
+  tai joiden rivit tarvitaan vain avainten vuoksi (ks. alla).
+  '''
+  query.lume_karsittu = True
+  return query
+  # def karsi_lumekentat
+
+
+@puukota(models.sql.query.Query)
+def get_aggregation(oletus, self, using, aggregates):
+  '''
+  Koostekyselyn (`count()`, `aggregate()`) mahdollinen sisempi kysely
+  (esim. `distinct()`, rajattu kysely) ei tarvitse lumekenttiä:
+  perusavain sisältyy valittuihin sarakkeisiin joka tapauksessa.
+  '''
+  karsi_lumekentat(self)
+  return oletus(self, using, aggregates)
+  # def get_aggregation
+
+
+@puukota(Collector)
+def collect(oletus, self, objs, *args, **kwargs):
+  '''
+  Poistettavien (ja kaskadipoiston kohteena olevien) rivien haku
+  ei tarvitse lumekenttiä; signaalien käsittelijät voivat edelleen
+  laskea ne tarvittaessa.
+  '''
+  # Karsitaan kopiota: kutsujan kysely voi olla edelleen käytössä.
+  if isinstance(objs, models.QuerySet) and objs._result_cache is None:
+    objs = objs.all()
+    karsi_lumekentat(objs.query)
+  return oletus(self, objs, *args, **kwargs)
+  # def collect
+
+
+@puukota(Collector)
+def related_objects(oletus, self, *args, **kwargs):
+  qs = oletus(self, *args, **kwargs)
+  karsi_lumekentat(qs.query)
+  return qs
+  # def related_objects
+
+
+# Kontekstikohtaiset (säie, asyncio-tehtävä) liput; ks. alla.
+_get_deferred_fields_ohita = ContextVar(
+  'lume_get_deferred_fields_ohita', default=False
+)
+_local_fields_ohita = ContextVar('lume_local_fields_ohita', default=False)
+
+
 @puukota(models.Model)
 def get_deferred_fields(oletus, self):
   '''
   Älä sisällytä lumekenttiä malli-olion `get_deferred_fields()`-paluuarvoon.
   Tätä joukkoa kysytään mallin tallentamisen ja kannasta lataamisen yhteydessä.
   '''
-  global __get_deferred_fields_ohita
-  if __get_deferred_fields_ohita:
+  if _get_deferred_fields_ohita.get():
     return oletus(self)
   return {
     kentta for kentta in oletus(self)
@@ -202,35 +509,56 @@ def refresh_from_db(oletus, self, **kwargs):
   Tyhjennä mahdolliset lumekentille aiemmin lasketut arvot;
   suorita sitten tavanomainen kantakysely.
   '''
-  global __get_deferred_fields_ohita
   data = self.__dict__
   for kentta in self._meta.concrete_fields:
     if isinstance(kentta, Lumekentta):
       data.pop(kentta.name, None)
       data.pop(kentta.get_attname(), None)
-  if __get_deferred_fields_ohita:
+  if _get_deferred_fields_ohita.get():
     return oletus(self, **kwargs)
-  __get_deferred_fields_ohita = True
-  paluu = oletus(self, **kwargs)
-  __get_deferred_fields_ohita = False
-  return paluu
+  lippu = _get_deferred_fields_ohita.set(True)
+  try:
+    return oletus(self, **kwargs)
+  finally:
+    _get_deferred_fields_ohita.reset(lippu)
   # def refresh_from_db
 
 
+class LocalFields:
+  '''
+  `Options.local_fields`, josta tallentamattomat lumekentät jätetään pois
+  `_ohita_lumekentat`-kontekstin sisällä.
+
+  Varsinainen luettelo on `Options`-olion omassa sanakirjassa,
+  jota Django muokkaa sellaisenaan (`add_field`).
+  '''
+
+  def __get__(self, instance, owner=None):
+    if instance is None:
+      return self
+    local_fields = instance.__dict__['local_fields']
+    if not _local_fields_ohita.get():
+      return local_fields
+    return type(local_fields)(
+      f for f in local_fields
+      if not isinstance(f, Lumekentta) or f.tallennettu
+    )
+    # def __get__
+
+  def __set__(self, instance, value):
+    instance.__dict__['local_fields'] = value
+    # def __set__
+
+  # class LocalFields
+
+
 @contextmanager
 def _ohita_lumekentat():
-  assert not hasattr(Options, 'local_fields')
-  def local_fields(self):
-    _local_fields = self.__dict__['local_fields']
-    return type(_local_fields)(
-      f for f in _local_fields
-      if not isinstance(f, Lumekentta)
-    )
-  Options.local_fields = property(local_fields)
+  lippu = _local_fields_ohita.set(True)
   try:
     yield
   finally:
-    del Options.local_fields
+    _local_fields_ohita.reset(lippu)
 
 
 @puukota(models.Model, koriste=classmethod)
@@ -244,3 +572,23 @@ def _check_field_name_clashes(oletus, cls):
 def _check_model(oletus, cls):
   with _ohita_lumekentat():
     return oletus.__func__(cls)
+
+
+def asenna():
+  '''
+  Asenna kaikki yllä määritetyt korvaukset Djangoon.
+
+  Kutsutaan ensimmäisen lumekentän liittyessä malliin sekä
+  `LumeConfig.ready`-metodista; toistuva kutsu ei tee mitään.
+  '''
+  global _asennettu # pylint: disable=global-statement
+  with _lukko:
+    if _asennettu:
+      return
+    for _asenna in _puukot:
+      _asenna()
+    models.Manager.lume = m_lume
+    models.Model.alume = alume
+    Options.local_fields = LocalFields()
+    _asennettu = True
+  # def asenna
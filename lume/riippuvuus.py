@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+'''
+Lumekenttien riippuvuuksien staattinen analyysi.
+
+Kentän kysely ratkaistaan mallin omaa kyselyä vasten ja lausekepuusta
+poimitaan kaikki ne (mallin) kentät, joiden arvoista tulos riippuu:
+sarakeviittaukset (`F`, `Q`, koostefunktiot), liitoksissa käytetyt
+viittauskentät, alikyselyjen (`Subquery`, `Exists`) ehdot, järjestys ja
+ryhmittely sekä `OuterRef`-viittaukset ulompaan malliin.
+
+Toiseen lumekenttään viittaava riippuvuus (lume -> lume) puretaan
+transitiivisesti `riippuvuudet(kentta, transitiivinen=True)`-kutsulla.
+'''
+
+from django.apps import apps
+from django.core.exceptions import FieldDoesNotExist
+from django.db import models
+from django.db.models.constants import LOOKUP_SEP
+from django.db.models.sql.datastructures import Join
+from django.db.models.sql.query import Query
+
+from .kentta import Lumekentta
+
+
+def _polun_kentat(malli, polku):
+  '''
+  Käy läpi hakupolun (esim. `lasku__paamies__nimi`) kentät;
+  lopun hakuehdot (`__gte` tms.) ohitetaan.
+  '''
+  for nimi in polku.split(LOOKUP_SEP):
+    if malli is None:
+      return
+    try:
+      kentta = malli._meta.pk if nimi == 'pk' else malli._meta.get_field(nimi)
+    except FieldDoesNotExist:
+      return
+    if isinstance(kentta, models.ForeignObjectRel):
+      kentta = kentta.field
+      malli = kentta.model
+    else:
+      malli = kentta.related_model
+    yield kentta
+  # def _polun_kentat
+
+
+def _lauseke(lauseke, malli, ulompi):
+  '''
+  Poimi lausekepuun riippuvuudet. `malli` on lausekkeen oman kyselyn
+  malli, `ulompi` ulomman kyselyn malli (`OuterRef`).
+  '''
+  if lauseke is None:
+    return
+  if isinstance(lauseke, Query):
+    # Alikysely (`Subquery`, `Exists`).
+    yield from _kysely(lauseke, malli)
+    return
+  if isinstance(lauseke, models.expressions.Col):
+    yield lauseke.target
+  elif isinstance(lauseke, models.expressions.ResolvedOuterRef):
+    yield from _polun_kentat(ulompi, lauseke.name)
+  elif isinstance(lauseke, models.F):
+    yield from _polun_kentat(malli, lauseke.name)
+  if hasattr(lauseke, 'get_source_expressions'):
+    for lapsi in lauseke.get_source_expressions():
+      yield from _lauseke(lapsi, malli, ulompi)
+  # def _lauseke
+
+
+def _kysely(query, ulompi):
+  ''' Poimi (ali)kyselyn riippuvuudet. '''
+  malli = query.model
+  for liitos in query.alias_map.values():
+    if isinstance(liitos, Join):
+      kentta = liitos.join_field
+      yield getattr(kentta, 'field', kentta) \
+        if isinstance(kentta, models.ForeignObjectRel) else kentta
+  for lauseke in (
+    query.where,
+    *query.select,
+    *query.annotations.values(),
+    *(
+      query.group_by if isinstance(query.group_by, tuple) else ()
+    ),
+  ):
+    yield from _lauseke(lauseke, malli, ulompi)
+  for jarjestys in query.order_by:
+    if isinstance(jarjestys, str):
+      nimi = jarjestys.lstrip('-')
+      if nimi not in query.annotations:
+        yield from _polun_kentat(malli, nimi)
+    else:
+      yield from _lauseke(jarjestys, malli, ulompi)
+  # def _kysely
+
+
+def suorat_riippuvuudet(kentta):
+  '''
+  Palauta lumekentän välittömät riippuvuudet (`frozenset` kenttiä).
+
+  Tulos tallennetaan kentälle kyselyversion mukaan.
+  '''
+  tallennettu = kentta.__dict__.get('_suorat_riippuvuudet')
+  if tallennettu is not None and tallennettu[0] == kentta.kyselyversio:
+    return tallennettu[1]
+  query = Query(kentta.model)
+  lauseke = kentta.kysely.resolve_expression(query)
+  tulos = frozenset(
+    riippuvuus
+    for riippuvuus in (
+      *_kysely(query, None),
+      *_lauseke(lauseke, kentta.model, kentta.model),
+    )
+    if riippuvuus is not kentta
+  )
+  kentta.__dict__['_suorat_riippuvuudet'] = (kentta.kyselyversio, tulos)
+  return tulos
+  # def suorat_riippuvuudet
+
+
+def riippuvuudet(kentta, transitiivinen=True):
+  '''
+  Palauta lumekentän riippuvuudet (`frozenset` kenttiä).
+
+  Oletuksena mukaan otetaan myös niiden lumekenttien riippuvuudet,
+  joihin kentän kysely viittaa (lume -> lume); itse lumekentät
+  sisältyvät tulokseen.
+  '''
+  if not transitiivinen:
+    return suorat_riippuvuudet(kentta)
+  tulos, kasiteltavat = set(), [kentta]
+  while kasiteltavat:
+    for riippuvuus in suorat_riippuvuudet(kasiteltavat.pop()):
+      if riippuvuus not in tulos:
+        tulos.add(riippuvuus)
+        if isinstance(riippuvuus, Lumekentta):
+          kasiteltavat.append(riippuvuus)
+  tulos.discard(kentta)
+  return frozenset(tulos)
+  # def riippuvuudet
+
+
+def riippuvat_mallit(kentta):
+  ''' Mallit, joiden rivien muutos voi muuttaa kentän arvoa. '''
+  return frozenset(
+    riippuvuus.model for riippuvuus in riippuvuudet(kentta)
+  ) | {kentta.model}
+  # def riippuvat_mallit
+
+
+def riippuvuusgraafi(mallit=None, transitiivinen=True):
+  '''
+  Muodosta riippuvuusgraafi: sanakirja `lumekenttä -> {kenttä}`
+  annettujen (oletuksena kaikkien asennettujen) mallien lumekentistä.
+  '''
+  return {
+    kentta: riippuvuudet(kentta, transitiivinen=transitiivinen)
+    for malli in (apps.get_models() if mallit is None else mallit)
+    for kentta in malli._meta.concrete_fields
+    if isinstance(kentta, Lumekentta)
+  }
+  # def riippuvuusgraafi
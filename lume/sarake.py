@@ -1,7 +1,114 @@
 # -*- coding: utf-8 -*-
 
+from collections import OrderedDict
+import threading
+import time
+
+from django.conf import settings
 from django.db import models
 
+from . import liitos, seuranta
+
+
+def _sisaltaa_liitoksia(kentta):
+  '''
+  Viittaako kentän kysely (transitiivisesti) johonkin lumekenttään,
+  joka voidaan laskea ryhmitellyn liitoksen avulla (ks. `liitos.py`)?
+  '''
+  # pylint: disable=import-outside-toplevel
+  from .kentta import Lumekentta
+  from .riippuvuus import riippuvuudet
+  try:
+    kentat = riippuvuudet(kentta)
+  except Exception: # pylint: disable=broad-except
+    return True
+  return any(
+    isinstance(riippuvuus, Lumekentta)
+    and riippuvuus.strategia == 'liitos'
+    and not riippuvuus.tallennettu
+    for riippuvuus in kentat
+  )
+  # def _sisaltaa_liitoksia
+
+
+class SQLValimuisti:
+  '''
+  Rajattu (LRU) välimuisti käännetyille lumesarakkeille.
+
+  Avaimena käytetään kenttää ja sen kyselyversiota, sarakkeen aliasta,
+  tietokantayhteyttä sekä ulomman kyselyn taulu- ja aliasrakennetta.
+  Välimuistin koko luetaan asetuksesta `LUME_SQL_VALIMUISTI`
+  (oletus 1024); arvo 0 ohittaa välimuistin.
+  '''
+
+  def __init__(self):
+    self._data = OrderedDict()
+    self._lukko = threading.Lock()
+    self.osumat = 0
+    self.ohitukset = 0
+
+  @property
+  def koko(self):
+    return getattr(settings, 'LUME_SQL_VALIMUISTI', 1024)
+
+  def avain(self, sarake, compiler, connection):
+    ''' Muodosta avain; `None`, mikäli tulosta ei voida tallentaa. '''
+    if not self.koko:
+      return None
+    query = compiler.query
+    avain = (
+      sarake.target,
+      sarake.target.kyselyversio,
+      sarake.alias,
+      sarake.output_field,
+      connection.vendor,
+      connection.alias,
+      liitos.kayta_liitosta(sarake.target, compiler, sarake.alias),
+      query.alias_prefix,
+      query.subq_aliases,
+      tuple(
+        (alias, type(liitos), liitos.identity,
+         getattr(liitos, 'join_type', None))
+        for alias, liitos in query.alias_map.items()
+      ),
+      tuple(query.external_aliases.items()),
+      tuple(query.annotations),
+    )
+    try:
+      hash(avain)
+    except TypeError:
+      # Ei-hajautettava rakenne (esim. `FilteredRelation`): ohitetaan.
+      return None
+    return avain
+    # def avain
+
+  def hae(self, avain):
+    with self._lukko:
+      try:
+        tulos = self._data[avain]
+      except KeyError:
+        self.ohitukset += 1
+        return None
+      self._data.move_to_end(avain)
+      self.osumat += 1
+      return tulos
+    # def hae
+
+  def tallenna(self, avain, tulos):
+    with self._lukko:
+      self._data[avain] = tulos
+      self._data.move_to_end(avain)
+      while len(self._data) > self.koko:
+        self._data.popitem(last=False)
+    # def tallenna
+
+  def tyhjenna(self):
+    with self._lukko:
+      self._data.clear()
+    # def tyhjenna
+
+  # class SQLValimuisti
+
 
 class Lumesarake(models.expressions.Col):
   '''
@@ -9,29 +116,115 @@ class Lumesarake(models.expressions.Col):
   '''
   # pylint: disable=abstract-method
 
+  valimuisti = SQLValimuisti()
+
   def as_sql(self, compiler, connection):
-    ''' Muodosta SELECT-lauseke ja siihen liittyvät SQL-parametrit. '''
+    '''
+    Muodosta SELECT-lauseke ja siihen liittyvät SQL-parametrit.
+
+    Seurannan ollessa käytössä kirjataan käännökseen kulunut aika
+    (ks. `seuranta.py`).
+    '''
+    if not seuranta.kaytossa():
+      return self._kaanna(compiler, connection)
+    alku = time.perf_counter()
+    try:
+      return self._kaanna(compiler, connection)
+    finally:
+      seuranta.kirjaa(self.target, 'sql', time.perf_counter() - alku)
+    # def as_sql
+
+  def _kaanna(self, compiler, connection):
+    '''
+    Palauta käännetty lauseke välimuistista tai käännä se.
+
+    Käännetty lauseke tallennetaan välimuistiin kyselyn rakenteen
+    mukaisella avaimella (ks. `SQLValimuisti`). Käännöksen aikana
+    ulompaan kyselyyn tehdyt muutokset (alikyselyjen aliakset,
+    liitosten viittauslaskurit) toistetaan välimuistista luettaessa.
+    '''
+    query = compiler.query
+    avain = self.valimuisti.avain(self, compiler, connection)
+    if avain is not None and (tulos := self.valimuisti.hae(avain)):
+      sql, params, viittaukset, aliakset = tulos
+      for alias, lkm in viittaukset.items():
+        query.alias_refcount[alias] += lkm
+      if aliakset:
+        query.subq_aliases = query.subq_aliases.union(aliakset)
+      return sql, type(params)(params)
+
+    ennen = (
+      frozenset(query.alias_map),
+      dict(query.alias_refcount),
+      query.subq_aliases,
+      dict(getattr(compiler, 'lume_liitokset', {})),
+    )
+    sql, params = self._as_sql(compiler, connection)
+    # Ryhmiteltyä liitosta (myös sisäkkäisen lumekentän) käyttävää
+    # lauseketta ei tallenneta: liitos kirjataan kääntäjälle
+    # (ks. `liitos.liita`) eikä sitä toisteta välimuistista luettaessa.
+    if avain is not None \
+    and frozenset(query.alias_map) == ennen[0] \
+    and getattr(compiler, 'lume_liitokset', {}) == ennen[3] \
+    and (self.target, self.alias) not in ennen[3] \
+    and not _sisaltaa_liitoksia(self.target):
+      self.valimuisti.tallenna(avain, (
+        sql,
+        type(params)(params),
+        {
+          alias: lkm - ennen[1].get(alias, 0)
+          for alias, lkm in query.alias_refcount.items()
+          if lkm != ennen[1].get(alias, 0)
+        },
+        query.subq_aliases - ennen[2],
+      ))
+    return sql, params
+    # def _kaanna
+
+  def _as_sql(self, compiler, connection):
+    ''' Käännä lumekentän kysely tämän sarakkeen aliaksen mukaisesti. '''
     # pylint: disable=unused-argument
     join = compiler.query.alias_map.get(self.alias)
-    if isinstance(join, models.sql.datastructures.Join):
-      # Liitostaulu: muodosta alikysely tähän tauluun,
-      # rajaa kysytty rivi liitostaulun primääriavaimen mukaan.
-      return compiler.compile(
-        models.Subquery(
-          self.target.model.objects.filter(
-            pk=models.expressions.RawSQL(
-              '%s.%s' % (
-                compiler.quote_name_unless_alias(join.table_alias),
-                connection.ops.quote_name(self.target.model._meta.pk.get_attname()),
-              ), ()
-            ),
-          ).values(**{
-            # Käytetään kentän nimestä poikkeavaa aliasta.
-            f'_{self.target.name}_join': self.target.kysely,
-          }),
-          output_field=self.field,
-        ).resolve_expression(query=compiler.query)
-      )
+    if isinstance(join, (
+      models.sql.datastructures.BaseTable,
+      models.sql.datastructures.Join,
+    )) and liitos.kayta_liitosta(self.target, compiler, self.alias):
+      # Ryhmitelty liitos: ks. `Lumekentta.strategia`.
+      alias = liitos.liita(self.target, compiler, self.alias)
+      return '%s.%s' % (
+        compiler.quote_name_unless_alias(alias),
+        connection.ops.quote_name(liitos.ARVO),
+      ), ()
+
+    elif isinstance(join, models.sql.datastructures.Join) \
+    or join is None and self.alias in compiler.query.external_aliases:
+      # Liitostaulu tai ulomman kyselyn taulu (`OuterRef`): muodosta
+      # alikysely tähän tauluun, rajaa kysytty rivi taulun primääriavaimen
+      # mukaan.
+      alikysely = models.Subquery(
+        self.target.model.objects.filter(
+          pk=models.expressions.RawSQL(
+            '%s.%s' % (
+              compiler.quote_name_unless_alias(self.alias),
+              connection.ops.quote_name(
+                self.target.model._meta.pk.get_attname()
+              ),
+            ), ()
+          ),
+        ).values(**{
+          # Käytetään kentän nimestä poikkeavaa aliasta.
+          f'_{self.target.name}_join': self.target.kysely,
+        }),
+        output_field=self.field,
+      ).resolve_expression(query=compiler.query)
+      if join is None:
+        # Ulomman kyselyn taulu voi olla samanniminen kuin alikyselyn
+        # taulu, jolloin jälkimmäinen peittäisi sen: annetaan alikyselylle
+        # omat aliakset (vrt. `Query.bump_prefix`).
+        alikysely.query.alias_prefix = compiler.query.alias_prefix
+        alikysely.query.subq_aliases |= compiler.query.subq_aliases
+        alikysely.query.bump_prefix(compiler.query)
+      return compiler.compile(alikysely)
       # if isinstance(join, Join)
 
     elif isinstance(join, models.sql.datastructures.BaseTable):
@@ -49,6 +242,6 @@ class Lumesarake(models.expressions.Col):
       raise NotImplementedError(
         f'not isinstance({join!r}, (BaseTable, Join))'
       )
-    # def as_sql
+    # def _as_sql
 
   # class Lumesarake
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+'''
+Lumekenttien laskennan seuranta.
+
+Kunkin kentän osalta kirjataan, miten sen arvo saatiin:
+- "sql": kenttä käännettiin osaksi kyselyä (`Lumesarake.as_sql`);
+  kirjataan myös käännökseen kulunut aika (sisältäen sisäkkäiset kentät);
+- "laske": paikallinen `laske`- tai `laske_joukko`-funktio;
+- "tulkki": kyselyn paikallinen tulkinta (ks. `tulkki.py`);
+- "kanta": erillinen kysely kannasta (ks. `Lumekentta._laske_paikallisesti`).
+
+Jokaisesta erillisestä kantakyselystä lähetetään signaali `kantakysely`
+(sender: malli; parametrit `kentta`, `kesto`, `rivit`, `kutsukohta`).
+
+Laskurit kerätään silloin, kun asetus `LUME_SEURANTA` on päällä, kun
+`LUME_SEURANTA_VIEJAT` on määritetty tai `seuraa()`-lohkon sisällä:
+
+  with lume.seuraa() as tilasto:
+    ...
+  tilasto(Lasku._meta.get_field('rivien_summa'))['kanta']
+
+Asetuksen `LUME_SEURANTA_VIEJAT` luettelemat funktiot (polkuina, esim.
+`'sovellus.mittarit.lume'`) saavat kunkin tapahtuman sanakirjana
+`{'malli', 'kentta', 'laji', 'kesto', ...}`.
+'''
+
+import contextlib
+import contextvars
+import functools
+import os
+import sys
+import threading
+
+from django.conf import settings
+from django.dispatch import Signal
+from django.utils.module_loading import import_string
+
+
+LAJIT = ('sql', 'laske', 'tulkki', 'kanta')
+
+
+kantakysely = Signal()
+
+
+class Tilasto:
+  ''' Kenttäkohtaiset laskurit ja kestot lajeittain. '''
+
+  def __init__(self):
+    self._lukko = threading.Lock()
+    self._laskurit = {}
+    # def __init__
+
+  def kirjaa(self, kentta, laji, kesto=0.0):
+    with self._lukko:
+      laskurit = self._laskurit.setdefault(
+        kentta, {laji: [0, 0.0] for laji in LAJIT}
+      )[laji]
+      laskurit[0] += 1
+      laskurit[1] += kesto
+    # def kirjaa
+
+  def __call__(self, kentta=None):
+    '''
+    Palauta kentän (tai kaikkien kenttien yhteenlasketut) laskurit
+    sanakirjana `{'sql': ..., 'laske': ..., 'tulkki': ..., 'kanta': ...,
+    'sql_aika': ..., 'kanta_aika': ...}` (ajat sekunteina).
+    '''
+    with self._lukko:
+      laskurit = [
+        arvot for avain, arvot in self._laskurit.items()
+        if kentta is None or avain is kentta
+      ]
+    tulos = {
+      laji: sum(arvot[laji][0] for arvot in laskurit) for laji in LAJIT
+    }
+    tulos['sql_aika'] = sum(arvot['sql'][1] for arvot in laskurit)
+    tulos['kanta_aika'] = sum(arvot['kanta'][1] for arvot in laskurit)
+    return tulos
+    # def __call__
+
+  def kentat(self):
+    ''' Kentät, joille on kirjattu tapahtumia. '''
+    with self._lukko:
+      return list(self._laskurit)
+    # def kentat
+
+  def tyhjenna(self):
+    with self._lukko:
+      self._laskurit.clear()
+    # def tyhjenna
+
+  # class Tilasto
+
+
+tilasto = Tilasto()
+
+_keraajat = contextvars.ContextVar('lume_seuranta', default=())
+
+
+@functools.lru_cache(maxsize=None)
+def _lataa_viejat(polut):
+  return tuple(import_string(polku) for polku in polut)
+  # def _lataa_viejat
+
+
+def _viejat():
+  return _lataa_viejat(tuple(getattr(settings, 'LUME_SEURANTA_VIEJAT', ())))
+  # def _viejat
+
+
+def kaytossa():
+  ''' Kerätäänkö tapahtumia tällä hetkellä? '''
+  return bool(
+    _keraajat.get()
+    or getattr(settings, 'LUME_SEURANTA', False)
+    or getattr(settings, 'LUME_SEURANTA_VIEJAT', ())
+  )
+  # def kaytossa
+
+
+def kirjaa(kentta, laji, kesto=0.0, **tiedot):
+  '''
+  Kirjaa tapahtuma laskureihin ja välitä se viejille; ohitetaan,
+  mikäli seuranta ei ole käytössä.
+  '''
+  if not kaytossa():
+    return
+  tilasto.kirjaa(kentta, laji, kesto)
+  for keraaja in _keraajat.get():
+    keraaja.kirjaa(kentta, laji, kesto)
+  if viejat := _viejat():
+    tapahtuma = {
+      'malli': kentta.model._meta.label,
+      'kentta': kentta.name,
+      'laji': laji,
+      'kesto': kesto,
+      **tiedot,
+    }
+    for vieja in viejat:
+      vieja(tapahtuma)
+  # def kirjaa
+
+
+_OHITETTAVAT = tuple(
+  os.path.dirname(moduuli.__file__) + os.sep
+  for moduuli in (
+    sys.modules[__package__],
+    sys.modules['django'],
+  )
+)
+
+
+def kutsukohta():
+  ''' Ensimmäinen kutsupinon kohta lumen ja Djangon ulkopuolella. '''
+  kehys = sys._getframe(1) # pylint: disable=protected-access
+  while kehys is not None:
+    if not kehys.f_code.co_filename.startswith(_OHITETTAVAT):
+      return f'{kehys.f_code.co_filename}:{kehys.f_lineno}'
+    kehys = kehys.f_back
+  return None
+  # def kutsukohta
+
+
+def kirjaa_kantakysely(kentta, kesto, rivit):
+  ''' Lähetä `kantakysely`-signaali ja kirjaa erillinen kantakysely. '''
+  kohta = kutsukohta()
+  kantakysely.send(
+    sender=kentta.model,
+    kentta=kentta,
+    kesto=kesto,
+    rivit=rivit,
+    kutsukohta=kohta,
+  )
+  kirjaa(kentta, 'kanta', kesto, rivit=rivit, kutsukohta=kohta)
+  # def kirjaa_kantakysely
+
+
+@contextlib.contextmanager
+def seuraa():
+  '''
+  Kerää lohkon aikana tapahtuneet laskennat omaan tilastoonsa
+  (vrt. `assertNumQueries`); lohkot voivat olla sisäkkäisiä.
+  '''
+  keraaja = Tilasto()
+  token = _keraajat.set((*_keraajat.get(), keraaja))
+  try:
+    yield keraaja
+  finally:
+    _keraajat.reset(token)
+  # def seuraa
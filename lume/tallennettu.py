@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+'''
+Tallennettujen (`tallennettu=True`) lumekenttien ylläpito.
+
+Tallennetun kentän arvo luetaan kannasta tavallisena sarakkeena.
+Sarake päivitetään kentän kyselyn mukaan niille riveille, joihin
+riippuvan mallin tallennus, poisto, `QuerySet.update()` tai
+`QuerySet.bulk_create()` vaikuttaa. Tallennus ja poisto käsitellään
+signaalien kautta rivi kerrallaan; esim. kaskadipoisto tekee kaksi
+kyselyä kutakin poistettavaa riippuvaa riviä kohti.
+
+Riippuvat mallit poimitaan kentän kyselyn riippuvuuksista
+(`riippuvuus.riippuvat_mallit`). Mikäli kysely on muotoa
+`Subquery(X.objects.filter(polku=OuterRef(...))...)`, polun varrella
+olevan mallin muutos vaikuttaa vain niihin ulomman mallin riveihin,
+joihin muuttuneet rivit (ennen ja jälkeen muutoksen) viittaavat; muiden
+riippuvien mallien muutos päivittää kentän kaikki rivit.
+'''
+
+import functools
+
+from django.apps import apps
+from django.db import connections, models
+from django.db.models.sql.constants import CURSOR
+from django.db.models.sql.datastructures import BaseTable
+from django.db.models.sql.subqueries import UpdateQuery
+
+from .kentta import Lumekentta
+
+
+def tallennetut_kentat():
+  ''' Kaikkien asennettujen mallien tallennetut lumekentät. '''
+  return [
+    kentta
+    for malli in apps.get_models()
+    for kentta in malli._meta.concrete_fields
+    if isinstance(kentta, Lumekentta) and kentta.tallennettu
+  ]
+  # def tallennetut_kentat
+
+
+def _polku(query, sarake):
+  '''
+  Muodosta kyselyn aloitusmallista sarakkeeseen johtava hakupolku
+  (esim. `lasku__paamies`) liitosten perusteella.
+  '''
+  osat = [sarake.target.name]
+  alias = sarake.alias
+  while not isinstance(liitos := query.alias_map[alias], BaseTable):
+    osat.insert(0, liitos.join_field.name)
+    alias = liitos.parent_alias
+  return osat
+  # def _polku
+
+
+def _alikyselyton(lauseke):
+  ''' Onko lauseke (esim. `F('a') + F('b')`) vailla alikyselyjä? '''
+  if isinstance(lauseke, models.sql.Query):
+    return False
+  return all(
+    _alikyselyton(lapsi)
+    for lapsi in getattr(lauseke, 'get_source_expressions', list)()
+    if lapsi is not None
+  )
+  # def _alikyselyton
+
+
+def vaikutuspolut(kentta):
+  '''
+  Palauta pari (avain, polut), missä polut on sanakirja
+  `malli -> (hakupolku, ...)`: mallin rivin muutos vaikuttaa niihin kentän
+  mallin riveihin, joiden `avain`-sarakkeen arvo saadaan kyselyllä
+  `malli.objects.filter(pk=...).values(hakupolku)`. Hakupolku `None`
+  tarkoittaa kaikkia rivejä.
+
+  Polut muodostetaan kullekin riippuvalle mallille (ks.
+  `riippuvuus.riippuvat_mallit`); kentän oma malli sisältyy aina näihin.
+  '''
+  # pylint: disable=import-outside-toplevel
+  from .liitos import _korrelaatio
+  from .riippuvuus import riippuvat_mallit, riippuvuudet
+  tallennettu = kentta.__dict__.get('_vaikutuspolut')
+  if tallennettu is not None and tallennettu[0] == kentta.kyselyversio:
+    return tallennettu[1]
+  avain, polut = 'pk', {}
+  query = getattr(kentta.kysely, 'query', None)
+  if isinstance(kentta.kysely, models.Subquery) \
+  and query is not None \
+  and (korrelaatio := _korrelaatio(kentta, query)) is not None:
+    ehto, ulompi = korrelaatio
+    osat = _polku(query, ehto.lhs)
+    malli = query.model
+    avain = ulompi.attname
+    polut[kentta.model] = [avain]
+    for indeksi in range(len(osat)):
+      polut.setdefault(malli, []).append('__'.join(osat[indeksi:]))
+      if indeksi < len(osat) - 1:
+        malli = malli._meta.get_field(osat[indeksi]).related_model
+  elif _alikyselyton(kentta.kysely) and not any(
+    isinstance(riippuvuus, Lumekentta) and not riippuvuus.tallennettu
+    for riippuvuus in riippuvuudet(kentta, transitiivinen=False)
+  ):
+    # Rivin omista sarakkeista laskettu arvo.
+    polut[kentta.model] = ['pk']
+  tulos = (avain, {
+    malli: tuple(polut.get(malli, (None, )))
+    for malli in riippuvat_mallit(kentta)
+  })
+  kentta.__dict__['_vaikutuspolut'] = (kentta.kyselyversio, tulos)
+  return tulos
+  # def vaikutuspolut
+
+
+@functools.lru_cache(maxsize=None)
+def _riippuvuuskartta():
+  '''
+  Kartta: malli -> luettelo (kenttä, hakupolku). Muodostetaan kerran
+  mallien latauduttua.
+  '''
+  kartta = {}
+  for kentta in tallennetut_kentat():
+    for malli, polut in vaikutuspolut(kentta)[1].items():
+      kartta.setdefault(malli, []).extend(
+        (kentta, polku) for polku in polut
+      )
+  return kartta
+  # def _riippuvuuskartta
+
+
+def vaikutukset(malli, rivit, using):
+  '''
+  Palauta sanakirja `kenttä -> {avain}` niistä tallennettujen kenttien
+  riveistä, joihin annetun mallin rivit (QuerySet tai pk-luettelo)
+  vaikuttavat (ks. `vaikutuspolut`); `kenttä -> None`, mikäli muutos
+  vaikuttaa kaikkiin riveihin.
+
+  Pk-luettelo käsitellään tietokannan parametrirajoitusten mukaisissa
+  erissä.
+  '''
+  tulos = {}
+  if isinstance(rivit, models.QuerySet):
+    erat = [rivit.order_by()]
+  else:
+    manager = malli._base_manager.db_manager(using)
+    rivit = list(rivit)
+    koko = max(connections[manager.db].ops.bulk_batch_size(
+      [malli._meta.pk], rivit
+    ), 1)
+    erat = [
+      manager.filter(pk__in=rivit[alku:alku + koko])
+      for alku in range(0, len(rivit), koko)
+    ]
+  for kentta, polku in _riippuvuuskartta().get(malli, ()):
+    if polku is None:
+      tulos[kentta] = None
+      continue
+    avaimet = set(
+      avain
+      for qs in erat
+      for avain in qs.values_list(polku, flat=True).distinct()
+      if avain is not None
+    )
+    if (aiemmat := tulos.setdefault(kentta, set())) is not None:
+      aiemmat.update(avaimet)
+  return tulos
+  # def vaikutukset
+
+
+def yhdista(*vaikutukset_):
+  ''' Yhdistä `vaikutukset`-funktion paluuarvot. '''
+  tulos = {}
+  for vaikutus in vaikutukset_:
+    for kentta, avaimet in vaikutus.items():
+      if avaimet is None:
+        tulos[kentta] = None
+      elif (aiemmat := tulos.setdefault(kentta, set())) is not None:
+        aiemmat.update(avaimet)
+  return tulos
+  # def yhdista
+
+
+def paivita(kentta, avaimet, using=None):
+  '''
+  Laske tallennetun kentän arvo uudelleen kyselyn mukaan annetuille
+  riveille (`UPDATE ... SET kenttä = (kysely) WHERE avain IN (...)`);
+  `avaimet=None` päivittää kaikki rivit.
+
+  Rivit käsitellään tietokannan parametrirajoitusten mukaisissa erissä.
+  '''
+  # pylint: disable=protected-access
+  manager = kentta.model._base_manager.db_manager(using)
+  if avaimet is None:
+    erat = [manager.all()]
+  else:
+    avaimet = list(avaimet)
+    avain = vaikutuspolut(kentta)[0]
+    koko = max(connections[manager.db].ops.bulk_batch_size(
+      [kentta.model._meta.pk], avaimet
+    ), 1)
+    erat = [
+      manager.filter(**{f'{avain}__in': avaimet[alku:alku + koko]})
+      for alku in range(0, len(avaimet), koko)
+    ]
+  for era in erat:
+    query = era.query.chain(UpdateQuery)
+    # Huom. `add_update_fields` ohittaa generoidut kentät.
+    query.values.append((kentta, None, kentta.kysely.resolve_expression(
+      query, allow_joins=False, for_save=True,
+    )))
+    query.get_compiler(manager.db).execute_sql(CURSOR)
+  # def paivita
+
+
+def paivita_vaikutukset(vaikutus, using=None):
+  ''' Päivitä `vaikutukset`-funktion palauttamat rivit. '''
+  for kentta, avaimet in vaikutus.items():
+    paivita(kentta, avaimet, using=using)
+  # def paivita_vaikutukset
+
+
+def _seurattu(malli):
+  '''
+  Riippuuko jokin tallennettu kenttä annetusta mallista? Riippuvuudet
+  päätellään vasta mallien latauduttua.
+  '''
+  return apps.models_ready and malli in _riippuvuuskartta()
+  # def _seurattu
+
+
+def _ennen_tallennusta(sender, instance, raw, using, **kwargs):
+  # pylint: disable=unused-argument
+  if raw or not _seurattu(sender):
+    return
+  instance._state.lume_vaikutukset = vaikutukset(
+    sender, [instance.pk], using
+  ) if instance.pk is not None else {}
+  # def _ennen_tallennusta
+
+
+def _tallennuksen_jalkeen(sender, instance, raw, using, **kwargs):
+  # pylint: disable=unused-argument
+  if raw or not _seurattu(sender):
+    return
+  paivita_vaikutukset(yhdista(
+    instance._state.__dict__.pop('lume_vaikutukset', {}),
+    vaikutukset(sender, [instance.pk], using),
+  ), using=using)
+  # def _tallennuksen_jalkeen
+
+
+def _ennen_poistoa(sender, instance, using, **kwargs):
+  # pylint: disable=unused-argument
+  if not _seurattu(sender):
+    return
+  instance._state.lume_vaikutukset = vaikutukset(
+    sender, [instance.pk], using
+  )
+  # def _ennen_poistoa
+
+
+def _poiston_jalkeen(sender, instance, using, **kwargs):
+  # pylint: disable=unused-argument
+  if not _seurattu(sender):
+    return
+  paivita_vaikutukset(
+    instance._state.__dict__.pop('lume_vaikutukset', {}),
+    using=using,
+  )
+  # def _poiston_jalkeen
+
+
+def kytke():
+  '''
+  Kytke ylläpito tallennus- ja poistosignaaleihin; vastaanottajat
+  ohittavat mallit, joista mikään tallennettu kenttä ei riipu.
+
+  Kutsutaan tallennetun kentän liittyessä malliin
+  (`Lumekentta.contribute_to_class`), jotta ylläpito toimii myös ilman
+  `lume`-sovellusta (`INSTALLED_APPS`), sekä `LumeConfig.ready`-metodista.
+  '''
+  _riippuvuuskartta.cache_clear()
+  for signaali, vastaanottaja in (
+    (models.signals.pre_save, _ennen_tallennusta),
+    (models.signals.post_save, _tallennuksen_jalkeen),
+    (models.signals.pre_delete, _ennen_poistoa),
+    (models.signals.post_delete, _poiston_jalkeen),
+  ):
+    signaali.connect(
+      vastaanottaja,
+      dispatch_uid=f'lume.tallennettu.{vastaanottaja.__name__}',
+    )
+  # def kytke
@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+'''
+Lumekentän kyselylausekkeen paikallinen tulkinta.
+
+Yksinkertainen kysely (`Q`, `F`, laskutoimitukset, `Case`/`When`,
+`Coalesce`, `ExpressionWrapper`, `Value`) käännetään Python-funktioksi,
+joka laskee kentän arvon rivin jo luettujen sarakkeiden perusteella:
+
+  arvo_yli_500 = lume.BooleanField(kysely=Q(rivien_summa__gte=500))
+
+Tulkintaa käytetään silloin, kun kentälle ei ole annettu `laske`-funktiota
+(tai se palauttaa EI_ASETETTU) ja kaikki lausekkeen viittaamat rivin omat
+sarakkeet on luettu; muuten arvo kysytään kannasta tavalliseen tapaan.
+
+NULL-arvoja käsitellään SQL:n tapaan (kolmiarvoinen logiikka). Mikäli
+laskenta epäonnistuu (esim. jako nollalla tai yhteensopimattomat tyypit),
+arvon määrittäminen jätetään tietokannalle. Huomaa, että laskutoimitusten
+tulos voi poiketa tietokannan omista tyyppisäännöistä (esim. SQLite jakaa
+kokonaislukuarvoiset desimaaliluvut kokonaislukujakona).
+'''
+
+from decimal import Decimal
+
+from django.db import models
+from django.db.models.functions import Coalesce
+from django.db.models.sql.query import Query
+from django.db.models.sql.where import WhereNode
+
+from .kentta import EI_ASETETTU
+
+
+class EiTuettu(Exception):
+  ''' Lauseketta ei voida tulkita paikallisesti. '''
+
+
+def _ja(arvot):
+  if any(arvo is False for arvo in arvot):
+    return False
+  if any(arvo is None for arvo in arvot):
+    return None
+  return True
+  # def _ja
+
+
+def _tai(arvot):
+  if any(arvo is True for arvo in arvot):
+    return True
+  if any(arvo is None for arvo in arvot):
+    return None
+  return False
+  # def _tai
+
+
+def _xor(arvot):
+  if any(arvo is None for arvo in arvot):
+    return None
+  return sum(1 for arvo in arvot if arvo) % 2 == 1
+  # def _xor
+
+
+def _jaa(a, b):
+  ''' SQL-jakolasku: kokonaislukujen osamäärä katkaistaan. '''
+  if isinstance(a, int) and isinstance(b, int):
+    osamaara = abs(a) // abs(b)
+    return osamaara if (a < 0) == (b < 0) else -osamaara
+  return a / b
+  # def _jaa
+
+
+def _jakojaannos(a, b):
+  ''' SQL-jakojäännös: etumerkki määräytyy jaettavan mukaan. '''
+  if isinstance(a, (int, Decimal)) and isinstance(b, (int, Decimal)):
+    if isinstance(a, Decimal) or isinstance(b, Decimal):
+      return Decimal(a) % Decimal(b)
+    jaannos = abs(a) % abs(b)
+    return -jaannos if a < 0 else jaannos
+  return a - b * int(a / b)
+  # def _jakojaannos
+
+
+LASKUTOIMITUKSET = {
+  models.expressions.Combinable.ADD: lambda a, b: a + b,
+  models.expressions.Combinable.SUB: lambda a, b: a - b,
+  models.expressions.Combinable.MUL: lambda a, b: a * b,
+  models.expressions.Combinable.DIV: _jaa,
+  models.expressions.Combinable.MOD: _jakojaannos,
+  models.expressions.Combinable.POW: lambda a, b: a ** b,
+}
+
+HAUT = {
+  'exact': lambda a, b: a == b,
+  'gt': lambda a, b: a > b,
+  'gte': lambda a, b: a >= b,
+  'lt': lambda a, b: a < b,
+  'lte': lambda a, b: a <= b,
+  'in': lambda a, b: a in b,
+  'range': lambda a, b: b[0] <= a <= b[1],
+}
+
+
+def _vakio(arvo):
+  return lambda data: arvo
+  # def _vakio
+
+
+def _haku(haku, alias, sarakkeet):
+  ''' Käännä hakuehto (`Exact`, `GreaterThan` jne.). '''
+  lhs = _kaanna(haku.lhs, alias, sarakkeet)
+  if haku.lookup_name == 'isnull':
+    if not isinstance(haku.rhs, bool):
+      raise EiTuettu(haku)
+    odotettu = haku.rhs
+    return lambda data: (lhs(data) is None) == odotettu
+  try:
+    vertailu = HAUT[haku.lookup_name]
+  except KeyError:
+    raise EiTuettu(haku) from None
+  if haku.lookup_name in ('in', 'range'):
+    if not isinstance(haku.rhs, (list, tuple, set, frozenset)) \
+    or any(hasattr(arvo, 'resolve_expression') for arvo in haku.rhs):
+      raise EiTuettu(haku)
+    rhs = _vakio(tuple(arvo for arvo in haku.rhs if arvo is not None))
+  elif hasattr(haku.rhs, 'resolve_expression'):
+    rhs = _kaanna(haku.rhs, alias, sarakkeet)
+  else:
+    rhs = _vakio(haku.rhs)
+  def _vertaa(data):
+    a, b = lhs(data), rhs(data)
+    if a is None or b is None:
+      return None
+    return vertailu(a, b)
+  return _vertaa
+  # def _haku
+
+
+def _ehto(ehto, alias, sarakkeet):
+  ''' Käännä ehtopuu (`WhereNode`). '''
+  lapset = [_kaanna(lapsi, alias, sarakkeet) for lapsi in ehto.children]
+  try:
+    yhdista = {'AND': _ja, 'OR': _tai, 'XOR': _xor}[ehto.connector]
+  except KeyError:
+    raise EiTuettu(ehto) from None
+  kaanna = ehto.negated
+  def _arvo(data):
+    arvo = yhdista([lapsi(data) for lapsi in lapset])
+    if kaanna and arvo is not None:
+      return not arvo
+    return arvo
+  return _arvo
+  # def _ehto
+
+
+def _case(lauseke, alias, sarakkeet):
+  ''' Käännä `Case(When(...), ..., default=...)`. '''
+  tapaukset = [
+    (
+      _kaanna(tapaus.condition, alias, sarakkeet),
+      _kaanna(tapaus.result, alias, sarakkeet),
+    )
+    for tapaus in lauseke.cases
+  ]
+  oletus = _kaanna(lauseke.default, alias, sarakkeet)
+  def _arvo(data):
+    for ehto, tulos in tapaukset:
+      if ehto(data) is True:
+        return tulos(data)
+    return oletus(data)
+  return _arvo
+  # def _case
+
+
+def _kaanna(lauseke, alias, sarakkeet):
+  '''
+  Käännä ratkaistu lauseke funktioksi `data -> arvo`, missä `data` on
+  rivin `__dict__`. Luettavien sarakkeiden nimet lisätään joukkoon
+  `sarakkeet`. Nostaa poikkeuksen `EiTuettu`, mikäli lauseketta ei voida
+  tulkita.
+  '''
+  # pylint: disable=too-many-return-statements
+  if isinstance(lauseke, WhereNode):
+    return _ehto(lauseke, alias, sarakkeet)
+  if isinstance(lauseke, models.lookups.Lookup):
+    return _haku(lauseke, alias, sarakkeet)
+  if isinstance(lauseke, models.expressions.Col):
+    if lauseke.alias != alias:
+      # Liitetyn taulun sarake.
+      raise EiTuettu(lauseke)
+    attname = lauseke.target.get_attname()
+    sarakkeet.add(attname)
+    return lambda data: data[attname]
+  if type(lauseke) is models.Value:
+    return _vakio(lauseke.value)
+  if type(lauseke) is models.ExpressionWrapper:
+    return _kaanna(lauseke.expression, alias, sarakkeet)
+  if type(lauseke) is models.expressions.CombinedExpression:
+    try:
+      laskutoimitus = LASKUTOIMITUKSET[lauseke.connector]
+    except KeyError:
+      raise EiTuettu(lauseke) from None
+    lhs = _kaanna(lauseke.lhs, alias, sarakkeet)
+    rhs = _kaanna(lauseke.rhs, alias, sarakkeet)
+    def _laske(data):
+      a, b = lhs(data), rhs(data)
+      if a is None or b is None:
+        return None
+      return laskutoimitus(a, b)
+    return _laske
+  if type(lauseke) is models.Case:
+    return _case(lauseke, alias, sarakkeet)
+  if type(lauseke) is Coalesce:
+    osat = [
+      _kaanna(osa, alias, sarakkeet)
+      for osa in lauseke.get_source_expressions()
+    ]
+    return lambda data: next(
+      (arvo for osa in osat if (arvo := osa(data)) is not None), None
+    )
+  raise EiTuettu(lauseke)
+  # def _kaanna
+
+
+def tulkitse(kentta):
+  '''
+  Käännä kentän kysely. Palauttaa parin (sarakkeet, funktio), missä
+  `sarakkeet` on laskentaan tarvittavien attribuuttien nimet, tai `None`,
+  mikäli kyselyä ei voida tulkita paikallisesti.
+
+  Tulos tallennetaan kentälle kyselyversion mukaan.
+  '''
+  tallennettu = kentta.__dict__.get('_tulkki')
+  if tallennettu is not None and tallennettu[0] == kentta.kyselyversio:
+    return tallennettu[1]
+  tulos = None
+  if hasattr(kentta.kysely, 'resolve_expression'):
+    query = Query(kentta.model)
+    lauseke = kentta.kysely.resolve_expression(query)
+    sarakkeet = set()
+    try:
+      funktio = _kaanna(lauseke, query.get_initial_alias(), sarakkeet)
+    except EiTuettu:
+      pass
+    else:
+      tulos = (frozenset(sarakkeet), funktio)
+  kentta.__dict__['_tulkki'] = (kentta.kyselyversio, tulos)
+  return tulos
+  # def tulkitse
+
+
+def laske(kentta, rivi):
+  '''
+  Laske kentän arvo rivin luettujen sarakkeiden perusteella.
+  Palauttaa EI_ASETETTU, mikäli tämä ei ole mahdollista.
+  '''
+  if (tulkinta := tulkitse(kentta)) is None:
+    return EI_ASETETTU
+  sarakkeet, funktio = tulkinta
+  data = rivi.__dict__
+  if any(
+    data.get(sarake, EI_ASETETTU) is EI_ASETETTU for sarake in sarakkeet
+  ):
+    return EI_ASETETTU
+  try:
+    return funktio(data)
+  except (ArithmeticError, TypeError, ValueError):
+    return EI_ASETETTU
+  # def laske
@@ -18,6 +18,7 @@ class Asiakas(models.Model):
       output_field=models.IntegerField()
     ),
     null=True,
+    strategia='liitos',
     laske=lambda rivi: next(
       (rivi[0] for rivi in sorted(
         rivi.osoitteet.values_list(
@@ -28,6 +29,15 @@ class Asiakas(models.Model):
       )),
       None
     ),
+    laske_joukko=lambda rivit: {
+      asiakas: osoite
+      for asiakas, osoite, _ in sorted(
+        Osoite.objects.filter(asiakas__in=rivit).values_list(
+          'asiakas', 'pk', 'osoite'
+        ),
+        key=lambda o: len(o[2]),
+      )
+    },
   )
   vanhin_lasku = lume.ForeignKey( # pylint: disable=no-member
     'Lasku',
@@ -39,6 +49,7 @@ class Asiakas(models.Model):
       ).order_by('numero').values('pk')[:1],
       output_field=models.IntegerField()
     ),
+    strategia='liitos',
     laske=lambda rivi: next(
       (rivi[0] for rivi in sorted(
         rivi.laskut.values_list(
@@ -60,6 +71,7 @@ class Asiakas(models.Model):
       ).order_by('-numero').values('pk')[:1],
       output_field=models.IntegerField()
     ),
+    strategia='liitos',
     null=True,
     laske=lambda rivi: next(
       (rivi[0] for rivi in sorted(
@@ -74,7 +86,6 @@ class Asiakas(models.Model):
   )
   useita_laskuja = lume.BooleanField( # pylint: disable=no-member
     kysely=~models.Q(viimeisin_lasku=models.F('vanhin_lasku')),
-    laske=lambda rivi: rivi.viimeisin_lasku != rivi.vanhin_lasku,
   )
 
 class Osoite(models.Model):
@@ -96,6 +107,21 @@ class Paamies(models.Model):
       ),
       output_field=models.DecimalField(),
     ),
+    strategia='liitos',
+  )
+  tallennettu_summa = lume.DecimalField( # pylint: disable=no-member
+    max_digits=11,
+    decimal_places=2,
+    kysely=lambda: models.Subquery(
+      Rivi.objects.filter(
+        lasku__paamies=models.OuterRef('pk'),
+      ).order_by('lasku__paamies').values('lasku__paamies').values(
+        summa_yht=models.Sum('summa'),
+      ),
+      output_field=models.DecimalField(),
+    ),
+    null=True,
+    tallennettu=True,
   )
 
 class Lasku(models.Model):
@@ -145,10 +171,6 @@ class Lasku(models.Model):
   )
   arvo_yli_500 = lume.BooleanField(
     kysely=models.Q(rivien_summa__gte=500),
-    laske=lambda rivi: (
-      rivi.rivien_summa is not None
-      and rivi.rivien_summa >= 500
-    ),
   )
 
 class Rivi(models.Model):
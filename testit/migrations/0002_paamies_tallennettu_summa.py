@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('testit', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='paamies',
+            name='tallennettu_summa',
+            field=models.DecimalField(decimal_places=2, max_digits=11, null=True),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+'''
+Lumekenttien suorituskykyvertailut.
+
+Vertailut ajetaan SQLite-muistikantaa vasten testimalleilla
+(`testit.mallit`), esim.
+
+  $ python -m vertailu.strategia
+  $ python -m vertailu.sivutus
+  $ python -m vertailu.kokonaisuus --tulos tulos.json
+  $ python -m vertailu.migraatiot
+'''
+
+import os
+import time
+
+
+def alusta():
+  ''' Alusta Django ja luo tyhjä muistikanta. '''
+  # pylint: disable=import-outside-toplevel
+  os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'vertailu.asetukset')
+  import django
+  django.setup()
+  from django.core.management import call_command
+  call_command('migrate', verbosity=0)
+  # def alusta
+
+
+def ajasta(funktio, toistot=5):
+  ''' Palauta funktion nopein suoritusaika sekunteina. '''
+  parhaat = []
+  for _ in range(toistot):
+    alku = time.perf_counter()
+    funktio()
+    parhaat.append(time.perf_counter() - alku)
+  return min(parhaat)
+  # def ajasta
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+'''
+Synteettinen testiaineisto kaikille testimalleille (`testit.mallit`).
+'''
+
+import random
+
+
+def luo_aineisto(
+  riveja,
+  riveja_per_lasku=10,
+  laskuja_per_asiakas=5,
+  laskuja_per_paamies=10,
+  osoitteita_per_asiakas=2,
+  siemen=0,
+):
+  '''
+  Luo `riveja` laskuriviä sekä niille laskut, asiakkaat, osoitteet
+  ja päämiehet annettujen suhteiden mukaan. Aineisto on toistettava
+  (`siemen`). Palauttaa sanakirjan `malli -> rivimäärä`.
+  '''
+  # pylint: disable=import-outside-toplevel
+  from testit.mallit import Asiakas, Lasku, Osoite, Paamies, Rivi
+  satunnainen = random.Random(siemen)
+  laskuja = max(riveja // riveja_per_lasku, 1)
+  asiakkaita = max(laskuja // laskuja_per_asiakas, 1)
+  paamiehia = max(laskuja // laskuja_per_paamies, 1)
+
+  Asiakas.objects.bulk_create((
+    Asiakas(nimi=f'Asiakas {i}') for i in range(asiakkaita)
+  ), batch_size=5000)
+  asiakkaat = list(Asiakas.objects.values_list('pk', flat=True))
+  Osoite.objects.bulk_create((
+    Osoite(
+      asiakas_id=asiakkaat[i % asiakkaita],
+      osoite='Katu ' + 'x' * satunnainen.randint(1, 40),
+    )
+    for i in range(asiakkaita * osoitteita_per_asiakas)
+  ), batch_size=5000)
+  Paamies.objects.bulk_create((
+    Paamies(nimi=f'Päämies {i}') for i in range(paamiehia)
+  ), batch_size=5000)
+  paamiehet = list(Paamies.objects.values_list('pk', flat=True))
+  Lasku.objects.bulk_create((
+    Lasku(
+      asiakas_id=asiakkaat[i % asiakkaita],
+      paamies_id=paamiehet[i % paamiehia],
+      numero=i,
+    )
+    for i in range(laskuja)
+  ), batch_size=5000)
+  laskut = list(Lasku.objects.values_list('pk', flat=True))
+  Rivi.objects.bulk_create((
+    Rivi(
+      lasku_id=laskut[i % laskuja],
+      summa=satunnainen.randint(1, 1000),
+      selite='',
+    )
+    for i in range(riveja)
+  ), batch_size=5000)
+  return {
+    malli._meta.label: malli.objects.count()
+    for malli in (Asiakas, Osoite, Paamies, Lasku, Rivi)
+  }
+  # def luo_aineisto
+
+
+def tyhjenna():
+  ''' Tyhjennä kanta seuraavaa aineistoa varten. '''
+  # pylint: disable=import-outside-toplevel
+  from django.core.management import call_command
+  call_command('flush', interactive=False, verbosity=0)
+  # def tyhjenna
@@ -0,0 +1,7 @@
+# pylint: disable=wildcard-import, unused-wildcard-import
+from testit.asetukset import *
+
+DATABASES = {'default': {
+  'ENGINE': 'django.db.backends.sqlite3',
+  'NAME': ':memory:',
+}}
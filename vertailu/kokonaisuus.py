@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+'''
+Lumekenttien vertailukokonaisuus eri aineistokoilla ja laskentatavoilla.
+
+Kullekin testimallien lumekenttien tyypille (top-1-viittaus, koostesumma,
+sisäkkäinen lumekenttä, Q-ehtoon perustuva totuusarvo) mitataan
+- kyselyn käännösaika (kylmä ja lämmin välimuisti);
+- SQL-kyselyn suoritusaika;
+- rivien luonnin kustannus (kokonaisaika - SQL-aika);
+- muistin huippukäyttö (`tracemalloc`);
+- erillisten kantakyselyjen määrä ja laskentatavat (ks. `lume.seuranta`).
+
+Tulokset kirjoitetaan JSON-muodossa, ja niitä voidaan verrata aiempaan
+ajoon (esim. toisen commitin tulokseen):
+
+  $ python -m vertailu.kokonaisuus --koot 1000 10000 --tulos uusi.json
+  $ python -m vertailu.kokonaisuus --koot 1000 10000 --vertaa vanha.json
+'''
+
+import argparse
+import datetime
+import json
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from . import ajasta, alusta
+from .aineisto import luo_aineisto, tyhjenna
+
+
+# Nimi, malli, kenttä ja mahdollinen laskentatapa, jossa
+# riippuvuudet luetaan kyselyn mukana (`tulkki`).
+KUVIOT = (
+  ('top1_viittaus', 'Asiakas', 'pisin_osoite', None),
+  ('koostesumma', 'Lasku', 'rivien_summa', None),
+  ('koostesumma_liitos', 'Paamies', 'laskujen_summa', None),
+  ('sisakkainen', 'Lasku', 'arvokkain_osuus', None),
+  ('q_totuusarvo', 'Lasku', 'arvo_yli_500', ('rivien_summa', )),
+)
+
+MITTARIT = (
+  'kaannos_kylma', 'kaannos', 'suoritus', 'instanssit', 'kokonais',
+  'muisti', 'kyselyt',
+)
+
+
+def _tyhjenna_valimuistit():
+  # pylint: disable=import-outside-toplevel
+  from lume.puukko import maskit
+  from lume.sarake import Lumesarake
+  Lumesarake.valimuisti.tyhjenna()
+  maskit.tyhjenna()
+  # def _tyhjenna_valimuistit
+
+
+def _muisti(funktio):
+  ''' Funktion suorituksen aikainen muistin huippukäyttö tavuina. '''
+  tracemalloc.start()
+  try:
+    funktio()
+    return tracemalloc.get_traced_memory()[1]
+  finally:
+    tracemalloc.stop()
+  # def _muisti
+
+
+def _laskennat(funktio):
+  '''
+  Suorita funktio; palauta kyselyjen määrä ja lume-seurannan
+  yhteenlasketut laskurit.
+  '''
+  # pylint: disable=import-outside-toplevel
+  from django.db import connection
+  from django.test.utils import CaptureQueriesContext
+  import lume
+  with CaptureQueriesContext(connection) as kyselyt, lume.seuraa() as tilasto:
+    funktio()
+  laskennat = tilasto()
+  return len(kyselyt), {
+    laji: laskennat[laji] for laji in ('sql', 'laske', 'tulkki', 'kanta')
+  }
+  # def _laskennat
+
+
+def mittaa_sql(qs, toistot):
+  ''' Mittaa kenttä kyselyn mukana laskettuna. '''
+  # pylint: disable=import-outside-toplevel
+  from django.db import connections
+
+  def kaanna():
+    return qs.query.clone().get_compiler(qs.db).as_sql()
+
+  def kylma():
+    _tyhjenna_valimuistit()
+    kaanna()
+
+  sql, params = kaanna()
+
+  def suorita():
+    with connections[qs.db].cursor() as kursori:
+      kursori.execute(sql, params)
+      return kursori.fetchall()
+
+  tulos = {
+    'kaannos_kylma': ajasta(kylma, toistot),
+    'kaannos': ajasta(kaanna, toistot),
+    'suoritus': ajasta(suorita, toistot),
+    'kokonais': ajasta(lambda: list(qs.all()), toistot),
+    'muisti': _muisti(lambda: list(qs.all())),
+    'riveja': len(suorita()),
+  }
+  tulos['instanssit'] = max(tulos['kokonais'] - tulos['suoritus'], 0.0)
+  tulos['kyselyt'], tulos['laskennat'] = _laskennat(lambda: list(qs.all()))
+  return tulos
+  # def mittaa_sql
+
+
+def mittaa_paikallinen(qs, kentta, toistot):
+  '''
+  Mittaa kenttä kyselyn jälkeen luettuna: `laske`-funktio,
+  kyselyn tulkinta tai erillinen kantakysely. Viittauskentästä luetaan
+  pelkkä avain (ei viitattua riviä).
+  '''
+  attname = qs.model._meta.get_field(kentta).get_attname()
+
+  def lue():
+    for rivi in list(qs.all()):
+      getattr(rivi, attname)
+
+  return {
+    'kokonais': ajasta(lue, toistot),
+    'muisti': _muisti(lue),
+    'riveja': qs.count(),
+    **dict(zip(('kyselyt', 'laskennat'), _laskennat(lue))),
+  }
+  # def mittaa_paikallinen
+
+
+def aja(koko, otos, toistot):
+  ''' Luo aineisto ja mittaa kaikki kuviot; palauttaa tulosluettelon. '''
+  # pylint: disable=import-outside-toplevel, cell-var-from-loop
+  from django.apps import apps
+  tyhjenna()
+  alku = time.perf_counter()
+  maarat = luo_aineisto(koko)
+  print(
+    f'{koko} riviä: {maarat} ({time.perf_counter() - alku:.1f}s)',
+    file=sys.stderr,
+  )
+  tulokset = []
+  for nimi, malli, kentta, riippuvuudet in KUVIOT:
+    malli = apps.get_model('testit', malli)
+    polut = {
+      'sql': lambda: mittaa_sql(
+        malli.objects.lume(kentta).order_by('pk'), toistot,
+      ),
+      'paikallinen': lambda: mittaa_paikallinen(
+        malli.objects.only('pk').order_by('pk')[:otos], kentta, toistot,
+      ),
+    }
+    if riippuvuudet:
+      polut['tulkki'] = lambda: mittaa_paikallinen(
+        malli.objects.only('pk', *riippuvuudet).order_by('pk')[:otos],
+        kentta, toistot,
+      )
+    for polku, mittaa in polut.items():
+      tulokset.append({
+        'koko': koko,
+        'kuvio': nimi,
+        'kentta': f'{malli._meta.label}.{kentta}',
+        'polku': polku,
+        **mittaa(),
+      })
+      print(_rivi(tulokset[-1]), file=sys.stderr)
+  return tulokset
+  # def aja
+
+
+def _rivi(tulos, vertailu=None):
+  osat = [f'{tulos["koko"]:>8} {tulos["kuvio"]:<20} {tulos["polku"]:<12}']
+  for mittari in MITTARIT:
+    if (arvo := tulos.get(mittari)) is None:
+      continue
+    teksti = f'{arvo * 1000:.2f}ms' if isinstance(arvo, float) else str(arvo)
+    if vertailu and vertailu.get(mittari):
+      teksti += f' ({arvo / vertailu[mittari]:.2f}x)'
+    osat.append(f'{mittari}={teksti}')
+  return ' '.join(osat)
+  # def _rivi
+
+
+def _ymparisto():
+  # pylint: disable=import-outside-toplevel
+  import sqlite3
+  import django
+  try:
+    commit = subprocess.run(
+      ['git', 'rev-parse', 'HEAD'],
+      capture_output=True, text=True, check=True,
+    ).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    commit = None
+  return {
+    'commit': commit,
+    'aika': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+    'python': platform.python_version(),
+    'django': django.get_version(),
+    'sqlite': sqlite3.sqlite_version,
+    'kone': platform.platform(),
+  }
+  # def _ymparisto
+
+
+def vertaa(tulokset, aiemmat):
+  ''' Tulosta suhteelliset muutokset aiempaan ajoon nähden. '''
+  avain = lambda tulos: (tulos['koko'], tulos['kuvio'], tulos['polku'])
+  aiemmat = {avain(tulos): tulos for tulos in aiemmat['tulokset']}
+  for tulos in tulokset:
+    if (aiempi := aiemmat.get(avain(tulos))) is not None:
+      print(_rivi(tulos, aiempi))
+  # def vertaa
+
+
+def main():
+  parser = argparse.ArgumentParser(
+    description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter,
+  )
+  parser.add_argument(
+    '--koot', type=int, nargs='+', default=[1_000, 10_000, 100_000],
+    help='laskurivien määrät (10³–10⁶)',
+  )
+  parser.add_argument(
+    '--otos', type=int, default=100,
+    help='erikseen luettavien rivien määrä (paikallinen laskenta)',
+  )
+  parser.add_argument('--toistot', type=int, default=3)
+  parser.add_argument('--tulos', help='JSON-tulostiedosto (oletus: stdout)')
+  parser.add_argument('--vertaa', help='aiempi JSON-tulos')
+  args = parser.parse_args()
+
+  alusta()
+  tulokset = []
+  for koko in args.koot:
+    tulokset.extend(aja(koko, args.otos, args.toistot))
+  data = {
+    'ymparisto': _ymparisto(),
+    'asetukset': vars(args),
+    'tulokset': tulokset,
+  }
+  if args.tulos:
+    with open(args.tulos, 'w', encoding='utf-8') as tiedosto:
+      json.dump(data, tiedosto, indent=2, ensure_ascii=False)
+  elif not args.vertaa:
+    json.dump(data, sys.stdout, indent=2, ensure_ascii=False)
+  if args.vertaa:
+    with open(args.vertaa, encoding='utf-8') as tiedosto:
+      vertaa(tulokset, json.load(tiedosto))
+  # def main
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+'''
+Mittaa migraatioiden muutostunnistuksen (`makemigrations`) kustannus
+suurella joukolla generoituja malleja, joista osalla on lumekenttiä.
+
+  $ python -m vertailu.migraatiot [--malleja 600] [--kenttia 10]
+'''
+
+import argparse
+
+from . import ajasta, alusta
+
+
+def luo_mallit(malleja, kenttia, lumeosuus=4):
+  '''
+  Luo erilliseen rekisteriin `malleja` mallia, joissa kussakin on
+  `kenttia` tavallista kenttää ja viittaus edelliseen malliin; joka
+  `lumeosuus`:nnessa mallissa on lisäksi kaksi lumekenttää.
+  Palauttaa rekisterin.
+  '''
+  # pylint: disable=import-outside-toplevel
+  from django.apps.registry import Apps
+  from django.db import models
+  import lume
+  rekisteri = Apps()
+  for i in range(malleja):
+    attrs = {
+      '__module__': 'vertailu.migraatiot',
+      'Meta': type('Meta', (), {
+        'apps': rekisteri, 'app_label': 'vertailu',
+      }),
+      **{
+        f'kentta_{j}': models.IntegerField(default=0)
+        for j in range(kenttia)
+      },
+    }
+    if i:
+      attrs['edellinen'] = models.ForeignKey(
+        f'vertailu.Malli{i - 1}', on_delete=models.CASCADE, null=True,
+      )
+    if i and i % lumeosuus == 0:
+      attrs['summa'] = lume.IntegerField(
+        kysely=models.F('kentta_0') + models.F('kentta_1'),
+      )
+      attrs['seuraajia'] = lume.IntegerField(
+        kysely=lambda kentta: models.Subquery(
+          kentta.model.objects.filter(
+            edellinen=models.OuterRef('pk'),
+          ).values('edellinen').annotate(
+            lkm=models.Count('pk'),
+          ).values('lkm'),
+        ),
+      )
+    type(f'Malli{i}', (models.Model, ), attrs)
+  return rekisteri
+  # def luo_mallit
+
+
+def projektitila(rekisteri):
+  ''' Vrt. `ProjectState.from_apps`. '''
+  # pylint: disable=import-outside-toplevel
+  from django.db.migrations.state import ModelState, ProjectState
+  tila = ProjectState()
+  for malli in rekisteri.all_models['vertailu'].values():
+    tila.add_model(ModelState.from_model(malli))
+  return tila
+  # def projektitila
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('--malleja', type=int, default=600)
+  parser.add_argument('--kenttia', type=int, default=10)
+  parser.add_argument('--lumeosuus', type=int, default=4)
+  parser.add_argument('--toistot', type=int, default=5)
+  args = parser.parse_args()
+
+  alusta()
+  # pylint: disable=import-outside-toplevel
+  from django.db.migrations.autodetector import MigrationAutodetector
+
+  rekisteri = luo_mallit(args.malleja, args.kenttia, args.lumeosuus)
+  tila = projektitila(rekisteri)
+  print(f'{args.malleja} mallia, {args.kenttia + 1} kenttää/malli')
+  for nimi, funktio in (
+    ('ProjectState', lambda: projektitila(rekisteri)),
+    ('MigrationAutodetector', lambda: MigrationAutodetector(tila, tila)),
+    ('changes (ei muutoksia)', lambda: MigrationAutodetector(
+      tila, projektitila(rekisteri),
+    )._detect_changes()),
+  ):
+    print(f'{nimi:<28} {ajasta(funktio, args.toistot) * 1000:>10.2f}ms')
+  # def main
+
+
+if __name__ == '__main__':
+  main()
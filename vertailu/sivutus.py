@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+'''
+Vertaa sivutetun kyselyn (`qs[alku:alku + 25]`) suoritusaikaa silloin,
+kun lumekentät lasketaan kaikille järjestettäville riveille
+(`LUME_SIVUTUS=False`) ja silloin, kun ne lasketaan vain sivun riveille.
+
+  $ python -m vertailu.sivutus [--riveja 100000]
+'''
+
+import argparse
+
+from . import ajasta, alusta
+from .strategia import luo_aineisto
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('--riveja', type=int, default=100_000)
+  parser.add_argument('--riveja-per-lasku', type=int, default=2)
+  parser.add_argument('--sivu', type=int, default=25)
+  args = parser.parse_args()
+
+  alusta()
+  # pylint: disable=import-outside-toplevel
+  from django.test.utils import override_settings
+  from testit.mallit import Lasku
+
+  luo_aineisto(args.riveja, args.riveja_per_lasku)
+  laskuja = Lasku.objects.count()
+  print(f'{args.riveja} riviä, {laskuja} laskua, sivu {args.sivu}')
+  print(f'{"alku":>10} {"kaikki":>12} {"sivu":>12}')
+  alku = 0
+  while alku < laskuja:
+    tulokset = []
+    for sivutus in (False, True):
+      with override_settings(LUME_SIVUTUS=sivutus):
+        tulokset.append(ajasta(lambda: list(
+          Lasku.objects.lume('rivien_summa').order_by(
+            '-numero'
+          )[alku:alku + args.sivu]
+        ), toistot=3))
+    print(f'{alku:>10} {tulokset[0]*1000:>10.2f}ms {tulokset[1]*1000:>10.2f}ms')
+    alku = alku * 4 if alku else args.sivu * 4
+  # def main
+
+
+if __name__ == '__main__':
+  main()
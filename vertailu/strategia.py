@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+'''
+Vertaa koostefunktion laskentaa korreloidulla alikyselyllä
+(`strategia='alikysely'`) ja ryhmitellyllä liitoksella
+(`strategia='liitos'`) eri kokoisille ulommille kyselyille.
+
+  $ python -m vertailu.strategia [--riveja 100000]
+'''
+
+import argparse
+import random
+
+from . import ajasta, alusta
+
+
+def luo_aineisto(riveja, riveja_per_lasku=10, laskuja_per_paamies=10):
+  ''' Luo `riveja` laskuriviä jaettuna laskuille ja päämiehille. '''
+  # pylint: disable=import-outside-toplevel
+  from testit.mallit import Asiakas, Lasku, Paamies, Rivi
+  satunnainen = random.Random(0)
+  laskuja = max(riveja // riveja_per_lasku, 1)
+  paamiehia = max(laskuja // laskuja_per_paamies, 1)
+  asiakas = Asiakas.objects.create(nimi='Asiakas')
+  Paamies.objects.bulk_create(
+    Paamies(nimi=f'Päämies {i}') for i in range(paamiehia)
+  )
+  paamiehet = list(Paamies.objects.values_list('pk', flat=True))
+  Lasku.objects.bulk_create(
+    Lasku(
+      asiakas=asiakas,
+      paamies_id=paamiehet[i % paamiehia],
+      numero=i,
+    )
+    for i in range(laskuja)
+  )
+  laskut = list(Lasku.objects.values_list('pk', flat=True))
+  Rivi.objects.bulk_create((
+    Rivi(
+      lasku_id=laskut[i % laskuja],
+      summa=satunnainen.randint(1, 1000),
+      selite='',
+    )
+    for i in range(riveja)
+  ), batch_size=5000)
+  return paamiehia
+  # def luo_aineisto
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('--riveja', type=int, default=100_000)
+  parser.add_argument('--riveja-per-lasku', type=int, default=10)
+  parser.add_argument('--laskuja-per-paamies', type=int, default=10)
+  args = parser.parse_args()
+
+  alusta()
+  # pylint: disable=import-outside-toplevel
+  from django.test.utils import override_settings
+  from testit.mallit import Paamies
+
+  paamiehia = luo_aineisto(
+    args.riveja, args.riveja_per_lasku, args.laskuja_per_paamies
+  )
+  kentta = Paamies._meta.get_field('laskujen_summa')
+  print(f'{args.riveja} riviä, {paamiehia} päämiestä')
+  print(f'{"rivejä":>10} {"alikysely":>12} {"liitos":>12}')
+  koko = 1
+  while True:
+    koko = min(koko, paamiehia)
+    tulokset = []
+    for strategia in ('alikysely', 'liitos'):
+      kentta.strategia = strategia
+      with override_settings(LUME_LIITOS_RAJA=0):
+        tulokset.append(ajasta(lambda: list(
+          Paamies.objects.order_by('pk').values_list(
+            'laskujen_summa', flat=True
+          )[:koko]
+        )))
+    print(f'{koko:>10} {tulokset[0]*1000:>10.2f}ms {tulokset[1]*1000:>10.2f}ms')
+    if koko == paamiehia:
+      break
+    koko *= 4
+  # def main
+
+
+if __name__ == '__main__':
+  main()